@@ -0,0 +1,160 @@
+"""Compare la mémoire résidente du cache gateway entre le profil par défaut et le profil basse mémoire.
+
+Chaque profil est mesuré dans des sous-processus propres : un commands.Bot est construit
+avec les options de bot/gateway.py, puis des payloads GUILD_CREATE, VOICE_STATE_UPDATE et
+MESSAGE_CREATE synthétiques sont injectés dans son état de connexion, sans connexion à Discord.
+Le RSS est mesuré dans un processus sans tracemalloc (dont le suivi fausserait la mesure),
+le tas Python dans un second processus avec tracemalloc.
+
+Usage: python -m benchmarks.gateway_memory --guilds 1000 --members 100 --messages 50
+"""
+import gc
+import os
+import sys
+import json
+import asyncio
+import argparse
+import subprocess
+import tracemalloc
+
+PROFILES = {"défaut": False, "basse mémoire": True}
+
+def resident_size():
+    """Current resident set size in bytes (Linux), 0 if unavailable"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return 0
+
+def user_payload(user_id):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None}
+
+def guild_payload(guild_id, members, voice_members):
+    text_channel_id = guild_id * 10 + 1
+    voice_channel_id = guild_id * 10 + 2
+    member_ids = [guild_id * 100000 + i for i in range(members)]
+    return {
+        "id": str(guild_id),
+        "name": f"Serveur {guild_id}",
+        "owner_id": str(member_ids[0]),
+        "member_count": members,
+        "large": members > 250,
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "104324673", "position": 0,
+                   "color": 0, "colors": {"primary_color": 0, "secondary_color": None, "tertiary_color": None},
+                   "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [
+            {"id": str(text_channel_id), "type": 0, "name": "général", "position": 0, "permission_overwrites": []},
+            {"id": str(voice_channel_id), "type": 2, "name": "Vocal", "position": 1, "permission_overwrites": [],
+             "bitrate": 64000, "user_limit": 0},
+        ],
+        # Sans l'intent privilégié members, Discord n'envoie que les membres en vocal
+        "members": [member_payload(member_id) for member_id in member_ids[:voice_members]],
+    }
+
+def member_payload(member_id):
+    return {"user": user_payload(member_id), "roles": [], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False}
+
+def voice_state_payload(guild_id, member_id):
+    """VOICE_STATE_UPDATE of a member joining the voice channel; it carries the member, which
+    py-cord caches when MemberCacheFlags.voice is set"""
+    return {"guild_id": str(guild_id), "user_id": str(member_id), "channel_id": str(guild_id * 10 + 2),
+            "session_id": "x", "deaf": False, "mute": False, "self_deaf": False, "self_mute": False,
+            "self_video": False, "suppress": False, "member": member_payload(member_id)}
+
+def message_payload(message_id, guild_id, author_id):
+    return {
+        "id": str(message_id),
+        "channel_id": str(guild_id * 10 + 1),
+        "guild_id": str(guild_id),
+        "author": user_payload(author_id),
+        "member": {"roles": [], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False},
+        "content": "Bonjour Ruber, comment ça va aujourd'hui ?",
+        "timestamp": "2024-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+async def measure(low_memory, guilds, members, messages, voice_members, trace):
+    import discord
+    from discord.ext import commands
+    from bot.gateway import get_bot_options
+
+    bot = commands.Bot(**get_bot_options(low_memory))
+    state = bot._connection
+    # Le compte du bot, normalement reçu dans READY
+    state.user = discord.ClientUser(state=state, data=user_payload(1))
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    rss_before = resident_size()
+
+    message_id = 1
+    for guild_id in range(1, guilds + 1):
+        state._add_guild_from_data(guild_payload(guild_id, members, voice_members))
+        for member_id in range(guild_id * 100000, guild_id * 100000 + voice_members):
+            state.parse_voice_state_update(voice_state_payload(guild_id, member_id))
+        for i in range(messages):
+            state.parse_message_create(message_payload(message_id, guild_id, guild_id * 100000 + i % members))
+            message_id += 1
+    await asyncio.sleep(0)
+    gc.collect()
+
+    result = {
+        "cached_members": sum(len(guild._members) for guild in bot.guilds),
+        "cached_messages": len(state._messages) if state._messages is not None else 0,
+    }
+    if trace:
+        result["traced"] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        result["rss"] = resident_size() - rss_before
+    return result
+
+def report(results, guilds):
+    print(f"\n{'profil':<16}{'RSS / 1000 serveurs':>22}{'Python / 1000 serveurs':>25}{'membres':>10}{'messages':>10}")
+    for name, result in results.items():
+        scale = 1000 / guilds / (1024 * 1024)
+        print(f"{name:<16}{result['rss'] * scale:>19.1f} Mo{result['traced'] * scale:>22.1f} Mo"
+              f"{result['cached_members']:>10}{result['cached_messages']:>10}")
+
+if __name__ == "__main__":
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, root)
+    parser = argparse.ArgumentParser(description="Mesure la mémoire du cache gateway par profil.")
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--members", type=int, default=100, help="Nombre de membres annoncé par serveur (member_count)")
+    parser.add_argument("--voice-members", type=int, default=2, help="Membres en vocal par serveur")
+    parser.add_argument("--messages", type=int, default=20, help="Messages reçus par serveur")
+    parser.add_argument("--profile", choices=list(PROFILES), help=argparse.SUPPRESS)
+    parser.add_argument("--trace", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        # Sous-processus: mesure d'un seul profil, résultat en JSON sur stdout
+        result = asyncio.run(measure(PROFILES[args.profile], args.guilds, args.members, args.messages, args.voice_members, args.trace))
+        print(json.dumps(result))
+        sys.exit(0)
+
+    results = {}
+    for name in PROFILES:
+        results[name] = {}
+        for trace in (False, True):
+            command = [sys.executable, "-m", "benchmarks.gateway_memory", "--profile", name, "--guilds", str(args.guilds),
+                       "--members", str(args.members), "--voice-members", str(args.voice_members), "--messages", str(args.messages)]
+            output = subprocess.run(command + ["--trace"] * trace, cwd=root, capture_output=True, text=True, check=True).stdout
+            results[name].update(json.loads(output.strip().splitlines()[-1]))
+    report(results, args.guilds)
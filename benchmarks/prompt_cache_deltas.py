@@ -0,0 +1,132 @@
+"""Vérifie avec un faux backend de cache que seul le suffixe non caché est envoyé à chaque tour.
+
+Une conversation synthétique est rejouée dans un ContextManager dont le PromptCache utilise
+FakeCacheBackend : à chaque tour, le préfixe en cache suivi des messages envoyés doit être
+exactement l'historique complet (aucun message renvoyé, aucun message manquant), et le suffixe
+doit rester sous le seuil de recréation du cache. Les tokens envoyés comptent aussi les préfixes
+téléversés à chaque création de cache, dont le nombre est borné. Rien n'est envoyé à l'API.
+
+Usage: python -m benchmarks.prompt_cache_deltas --turns 200 --message-tokens 500 --evict-every 50
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class CacheEvicted(Exception):
+    pass
+
+class FakeCacheBackend:
+    """Local stand-in for GeminiCacheBackend that keeps cached prefixes in memory"""
+
+    def __init__(self, token_counter):
+        self.token_counter = token_counter
+        self.caches = {}
+        self.created = 0
+        self.uploaded_tokens = 0
+        self.requests = []
+
+    def create(self, model_name, system_prompt, messages, ttl):
+        self.created += 1
+        self.uploaded_tokens += sum(self.token_counter(messages))
+        name = f"cachedContents/fake-{self.created}"
+        self.caches[name] = [{"role": msg["role"], "parts": msg["parts"]} for msg in messages]
+        return name, time.time() + ttl
+
+    def extend(self, cache_name, ttl):
+        return time.time() + ttl
+
+    def delete(self, cache_name):
+        self.caches.pop(cache_name, None)
+
+    def evict(self):
+        """Drop every cache, as the server does when a cache expires or is deleted elsewhere"""
+        self.caches.clear()
+
+    def generate(self, cache_name, messages):
+        if cache_name not in self.caches:
+            raise CacheEvicted(f"{cache_name} introuvable")
+        self.requests.append((cache_name, messages))
+        return iter([FakeChunk("ok")])
+
+def history(messages):
+    return [{"role": msg["role"], "parts": msg["parts"]} for msg in messages if msg["role"] in ("user", "model")]
+
+def main(args):
+    # Contextes dans un répertoire jetable
+    os.chdir(tempfile.mkdtemp(prefix="prompt_cache_deltas_"))
+
+    import utils.context as context_module
+    from utils.models import model_registry
+    from utils.prompt_cache import PromptCache
+    count = lambda content, model_name=None: len(str(content)) // 4
+    context_module.count_tokens = count
+    model_registry.refresh_in_background = lambda force=False: None
+
+    context = context_module.ContextManager(1)
+    context.set_media_aging(0, 0)
+    context.set_compaction(False)
+    context.set_retrieval(False)
+    context.set_context_size(args.context_size)
+
+    backend = FakeCacheBackend(context._count_message_tokens)
+    full_requests = []
+
+    def fallback(messages, model_name=None, system_prompt=None):
+        full_requests.append(messages)
+        return iter([FakeChunk("ok")])
+
+    cache = PromptCache(context._count_message_tokens, backend=backend, fallback=fallback,
+                        min_tokens=args.min_tokens, refresh_tokens=args.refresh_tokens)
+    context.prompt_cache = cache
+
+    sent_tokens = full_tokens = added_tokens = evictions = 0
+    for turn in range(1, args.turns + 1):
+        if args.evict_every and turn % args.evict_every == 0:
+            backend.evict()
+            evictions += 1
+        context.add_message("user", f"Utilisateur {turn}: " + "bla " * args.message_tokens)
+        messages = context.get_request_context()
+        requests_before = len(backend.requests)
+        list(cache.generate(messages, context.model_name, context.system_prompt))
+
+        expected = history(messages)
+        full_tokens += sum(count(msg["parts"][0]) for msg in expected)
+        if len(backend.requests) > requests_before:
+            cache_name, suffix = backend.requests[-1]
+            suffix = history(suffix)
+            assert backend.caches[cache_name] + suffix == expected, f"tour {turn}: préfixe en cache + suffixe != historique"
+            suffix_tokens = sum(count(msg["parts"][0]) for msg in suffix)
+            recent_tokens = sum(count(msg["parts"][0]) for msg in expected[-cache.keep_recent:])
+            assert suffix_tokens < cache.refresh_tokens + recent_tokens, f"tour {turn}: suffixe de {suffix_tokens} tokens"
+            sent_tokens += suffix_tokens
+        else:
+            assert full_requests and full_requests[-1] is messages, f"tour {turn}: aucune requête envoyée"
+            sent_tokens += sum(count(msg["parts"][0]) for msg in expected)
+        context.add_message("model", f"Réponse {turn}: " + "ok " * (args.message_tokens // 2))
+        added_tokens += sum(context.context_data["token_counts"][-2:])
+
+    # Un cache est recréé au plus une fois par bloc élagué et une fois par bloc de nouvel historique
+    block = min(cache.refresh_tokens, context.context_size // 2)
+    max_created = 2 * added_tokens // block + evictions + 2
+    assert backend.created <= max_created, f"{backend.created} caches créés, {max_created} attendus au plus"
+    sent_tokens += backend.uploaded_tokens
+    print(f"{args.turns} tours vérifiés: {len(backend.requests)} depuis le cache, {len(full_requests)} avec le contexte complet, "
+          f"{backend.created} caches créés")
+    print(f"Tokens d'historique envoyés (préfixes mis en cache compris): {sent_tokens} sur {full_tokens} ({100 * (1 - sent_tokens / max(full_tokens, 1)):.0f} % économisés)")
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description="Vérifie que le cache de prompt n'envoie que le suffixe non caché.")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--message-tokens", type=int, default=500, help="Taille approximative d'un message utilisateur")
+    parser.add_argument("--min-tokens", type=int, default=32768)
+    parser.add_argument("--refresh-tokens", type=int, default=32768)
+    parser.add_argument("--context-size", type=int, default=200000, help="Taille du contexte, pour tester l'élagage")
+    parser.add_argument("--evict-every", type=int, default=0, help="Supprime les caches côté serveur tous les N tours")
+    main(parser.parse_args())
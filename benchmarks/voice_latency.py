@@ -0,0 +1,232 @@
+"""Mesure la latence aller-retour du chat vocal sans connexion Discord.
+
+Des paquets PCM (synthétiques ou issus d'un fichier wav 48 kHz stéréo 16 bits) sont
+envoyés en temps réel à GlobalSilenceWatcher.write, puis on_audio_data_ready tourne
+avec un faux backend Gemini et une fausse synthèse vocale aux latences configurables.
+L'audio remis au client vocal est capturé et le délai est découpé par étape.
+
+Usage: python -m benchmarks.voice_latency --runs 5 --gemini-first-chunk 0.8 --tts-first-byte 0.3
+
+ffmpeg doit être installé (encodage mp3 de pydub), comme pour le bot.
+"""
+import os
+import sys
+import math
+import time
+import wave
+import struct
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+FRAME_DURATION = 0.02  # Discord envoie des paquets de 20 ms
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_BYTES = int(SAMPLE_RATE * FRAME_DURATION) * CHANNELS * 2
+
+STAGES = [
+    ("fin de parole", "last_packet", "callback"),
+    ("encodage + contexte", "callback", "request"),
+    ("requête -> premier chunk", "request", "first_chunk"),
+    ("fin de la réponse", "first_chunk", "tts_request"),
+    ("TTS premier octet", "tts_request", "tts_first_byte"),
+    ("début de lecture", "tts_first_byte", "playback"),
+]
+
+class Timeline:
+    """Timestamps of one round-trip, first occurrence wins"""
+
+    def __init__(self):
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks.setdefault(name, time.perf_counter())
+
+def synthetic_frames(duration, frequency=220.0, amplitude=0.5):
+    """Yield 20 ms stereo frames of a sine wave loud enough to pass the volume threshold"""
+    samples_per_frame = FRAME_BYTES // (CHANNELS * 2)
+    for frame_index in range(int(duration / FRAME_DURATION)):
+        samples = []
+        for i in range(samples_per_frame):
+            t = (frame_index * samples_per_frame + i) / SAMPLE_RATE
+            value = int(amplitude * 32767 * math.sin(2 * math.pi * frequency * t))
+            samples.extend((value, value))
+        yield struct.pack(f"<{len(samples)}h", *samples)
+
+def wav_frames(path):
+    """Yield 20 ms frames from a 48 kHz stereo 16 bit wav file"""
+    with wave.open(path, "rb") as wav:
+        if (wav.getframerate(), wav.getnchannels(), wav.getsampwidth()) != (SAMPLE_RATE, CHANNELS, 2):
+            raise SystemExit("Le fichier doit être en 48 kHz, stéréo, 16 bits (format des paquets Discord).")
+        while True:
+            data = wav.readframes(FRAME_BYTES // (CHANNELS * 2))
+            if len(data) < FRAME_BYTES:
+                return
+            yield data
+
+def feed_packets(sink, frames, timeline):
+    """Write frames to the sink at real-time pace, as the voice receive thread does"""
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        delay = start + i * FRAME_DURATION - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        sink.write(frame, user=1)
+        timeline.marks["last_packet"] = time.perf_counter()
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+def fake_gemini(timeline, first_chunk_latency, chunk_interval, chunks):
+    def backend(messages, model_name=None, system_prompt=None):
+        timeline.mark("request")
+        time.sleep(first_chunk_latency)
+        for i in range(chunks):
+            if i:
+                time.sleep(chunk_interval)
+            yield FakeChunk(f"Morceau {i + 1} de la réponse. ")
+    return backend
+
+def fake_tts(timeline, first_byte_latency, byte_interval, chunks):
+    def synthesize_speech(text):
+        timeline.mark("tts_request")
+        time.sleep(first_byte_latency)
+        for i in range(chunks):
+            if i:
+                time.sleep(byte_interval)
+            timeline.mark("tts_first_byte")
+            yield b"\xff\xfb\x90\x00" + bytes(413)
+    return synthesize_speech
+
+class FakeMessage:
+    async def edit(self, content=None):
+        pass
+
+    async def delete(self):
+        pass
+
+class FakeChannel:
+    def __init__(self, channel_id, timeline):
+        self.id = channel_id
+        self.timeline = timeline
+
+    async def send(self, content=None, **kwargs):
+        self.timeline.mark("first_chunk")
+        return FakeMessage()
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeContext:
+    def __init__(self, channel, guild):
+        self.channel = channel
+        self.guild = guild
+
+class FakeVoiceClient:
+    """Captures the audio source handed over for playback"""
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.sources = []
+
+    def is_playing(self):
+        return False
+
+    def stop(self):
+        pass
+
+    def play(self, source, after=None):
+        self.timeline.mark("playback")
+        self.sources.append(source)
+        source.cleanup()
+        if after:
+            after(None)
+
+async def run_once(args, bot_module, audio_module, channel_id):
+    timeline = Timeline()
+    bot_module.model_router.backend = fake_gemini(timeline, args.gemini_first_chunk, args.gemini_chunk_interval, args.gemini_chunks)
+    audio_module.synthesize_speech = fake_tts(timeline, args.tts_first_byte, args.tts_chunk_interval, args.tts_chunks)
+
+    guild = FakeGuild(channel_id)
+    ctx = FakeContext(FakeChannel(channel_id, timeline), guild)
+    voice_client = FakeVoiceClient(timeline)
+    bot_module.voice_clients[guild.id] = voice_client
+
+    finished = asyncio.Event()
+
+    async def callback(buffer):
+        timeline.mark("callback")
+        try:
+            await bot_module.on_audio_data_ready(buffer, ctx)
+        finally:
+            finished.set()
+
+    sink = audio_module.GlobalSilenceWatcher(callback=callback, timeout=args.silence_timeout)
+    watcher = asyncio.create_task(sink.check_silence())
+    frames = wav_frames(args.wav) if args.wav else synthetic_frames(args.speech_duration)
+    await asyncio.to_thread(feed_packets, sink, frames, timeline)
+    try:
+        await asyncio.wait_for(finished.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    watcher.cancel()
+    if "playback" not in timeline.marks:
+        raise SystemExit(f"Pas de lecture audio après {args.timeout} s, étapes atteintes: {sorted(timeline.marks)}")
+    return timeline.marks
+
+def report(runs):
+    print(f"\n{'étape':<28}{'médiane':>10}{'min':>10}{'max':>10}")
+    for label, start, end in STAGES + [("total bouche -> oreille", "last_packet", "playback")]:
+        durations = [(marks[end] - marks[start]) * 1000 for marks in runs if start in marks and end in marks]
+        if durations:
+            print(f"{label:<28}{statistics.median(durations):>8.0f}ms{min(durations):>8.0f}ms{max(durations):>8.0f}ms")
+        else:
+            print(f"{label:<28}{'n/a':>10}")
+
+async def main(args):
+    # Contextes et fichiers d'état dans un répertoire jetable
+    workdir = tempfile.mkdtemp(prefix="voice_latency_")
+    os.chdir(workdir)
+
+    import utils.context as context_module
+    import utils.audio as audio_module
+    from utils.models import model_registry
+    context_module.count_tokens = lambda content, model_name=None: len(str(content)) // 4
+    model_registry.refresh_in_background = lambda force=False: None
+    import bot.bot as bot_module
+
+    channel_id = 1
+    bot_module.activated_channels.add(channel_id)
+    context = bot_module.get_channel_context(channel_id)
+    # Aucun appel réel à l'API, quel que soit le .env: tout passe par le faux backend
+    context.set_media_aging(0, 0)
+    context.set_compaction(False)
+    context.set_prompt_cache(False)
+    context.set_retrieval(False)
+
+    runs = []
+    for i in range(args.runs):
+        marks = await run_once(args, bot_module, audio_module, channel_id)
+        total = (marks["playback"] - marks["last_packet"]) * 1000
+        print(f"Essai {i + 1}/{args.runs}: {total:.0f} ms de la fin de parole au début de la lecture")
+        runs.append(marks)
+    report(runs)
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description="Mesure la latence aller-retour du chat vocal.")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--wav", help="Fichier wav 48 kHz stéréo 16 bits à utiliser à la place du signal synthétique")
+    parser.add_argument("--speech-duration", type=float, default=2.0, help="Durée du signal synthétique (s)")
+    parser.add_argument("--silence-timeout", type=float, default=3.0, help="Silence avant fin de parole (s)")
+    parser.add_argument("--gemini-first-chunk", type=float, default=0.8, help="Latence du premier chunk Gemini (s)")
+    parser.add_argument("--gemini-chunk-interval", type=float, default=0.1, help="Intervalle entre chunks Gemini (s)")
+    parser.add_argument("--gemini-chunks", type=int, default=3)
+    parser.add_argument("--tts-first-byte", type=float, default=0.3, help="Latence du premier octet TTS (s)")
+    parser.add_argument("--tts-chunk-interval", type=float, default=0.05, help="Intervalle entre chunks TTS (s)")
+    parser.add_argument("--tts-chunks", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    asyncio.run(main(parser.parse_args()))
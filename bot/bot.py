@@ -1,7 +1,7 @@
 import base64
 import discord
 from discord.ext import commands
-from utils.gemini import generate_images, generate_response, handle_api_error, list_models, setup_gemini_api
+from utils.gemini import handle_api_error, setup_gemini_api
 from utils.attachments import MessageAttachment
 import os
 import re
@@ -11,6 +11,16 @@ import asyncio
 import io
 from utils.context import ContextManager
 from utils.audio import join_voice_channel, leave_voice_channel, play_tts, GlobalSilenceWatcher, start_recording
+from utils.config import (
+    get_loop_lag_monitor_enabled, get_loop_lag_threshold, get_loop_lag_dump_file,
+    get_imagen_max_concurrent, get_imagen_max_per_guild, get_imagen_cache_size,
+    get_fallback_model, get_hedge_deadline
+)
+from utils.loop_monitor import LoopLagMonitor
+from utils.imagen import ImagenQueue
+from utils.models import model_registry
+from utils.routing import ModelRouter
+from utils.export import parse_filters, group_parts
 import pydub
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -19,9 +29,14 @@ logger = logging.getLogger(__name__)
 channel_contexts = {}
 ACTIVATED_CHANNELS_FILE = "activated_channels.json"
 DISCORD_MESSAGE_LENGTH_LIMIT = 2000
+DISCORD_MAX_FILES_PER_MESSAGE = 10
+DISCORD_DEFAULT_FILESIZE_LIMIT = 8 * 1024 * 1024
 tts_enabled_channels = set()
 voice_clients = {}
 voice_chat_channels = {}
+loop_monitor = LoopLagMonitor(threshold=get_loop_lag_threshold(), dump_file=get_loop_lag_dump_file())
+imagen_queue = ImagenQueue(get_imagen_max_concurrent(), get_imagen_max_per_guild(), get_imagen_cache_size())
+model_router = ModelRouter(get_fallback_model(), get_hedge_deadline())
 
 def load_activated_channels():
     try:
@@ -64,18 +79,18 @@ async def on_audio_data_ready(buffer, ctx):
     context.add_message("user", message_parts)
     try:
         logger.info("on_message: Appel de generate_response")
-        response = generate_response(context.get_context(), context.model_name, context.system_prompt)
+        response = model_router.stream(await asyncio.to_thread(context.get_request_context), context.model_name, context.system_prompt, context.get_prompt_cache())
         response_text = ""
         sent_message = None
         logger.info("on_message: Début de la boucle de réception des chunks")
-        for chunk in response:
-            logger.info(f"on_message: Chunk reçu: {chunk.text}")
-            if sent_message and len(response_text) + len(chunk.text) > DISCORD_MESSAGE_LENGTH_LIMIT - 3:
+        async for chunk_text in response:
+            logger.info(f"on_message: Chunk reçu: {chunk_text}")
+            if sent_message and len(response_text) + len(chunk_text) > DISCORD_MESSAGE_LENGTH_LIMIT - 3:
                 logger.info("on_message: Envoi du message actuel car le prochain chunk ferait dépasser la limite")
                 await sent_message.edit(content=response_text)
                 sent_message = await ctx.channel.send("...")
                 response_text = ""
-            response_text += chunk.text
+            response_text += chunk_text
             if sent_message:
                 if len(response_text) <= DISCORD_MESSAGE_LENGTH_LIMIT - 3:
                     await sent_message.edit(content=response_text + "...")
@@ -97,7 +112,7 @@ async def on_audio_data_ready(buffer, ctx):
             await ctx.channel.send(response_text)
             await play_tts(voice_clients[ctx.guild.id], response_text)
         logger.info(f"on_message: Ajout de la réponse au contexte: {response_text}")
-        context.add_message("model", response_text)
+        context.add_message("model", response_text, model=response.model)
     except Exception as e:
         logger.error(f"on_message: Une erreur est survenue: {e}")
         error_message = handle_api_error(e)
@@ -113,6 +128,9 @@ class BotCommands(commands.Cog):
     async def on_ready(self):
         logger.info(f"{self.bot.user} est prêt et connecté à Discord!")
         setup_gemini_api()
+        if get_loop_lag_monitor_enabled():
+            loop_monitor.start()
+        model_registry.refresh_in_background()
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -167,21 +185,21 @@ class BotCommands(commands.Cog):
         try:
         # Générer la réponse
             logger.info("on_message: Appel de generate_response")
-            response = generate_response(context.get_context(), context.model_name, context.system_prompt)
+            response = model_router.stream(await asyncio.to_thread(context.get_request_context), context.model_name, context.system_prompt, context.get_prompt_cache())
             response_text = ""
             sent_message = None
 
             logger.info("on_message: Début de la boucle de réception des chunks")
-            for chunk in response:
-                logger.info(f"on_message: Chunk reçu: {chunk.text}")
+            async for chunk_text in response:
+                logger.info(f"on_message: Chunk reçu: {chunk_text}")
             
-                if sent_message and len(response_text) + len(chunk.text) > DISCORD_MESSAGE_LENGTH_LIMIT - 3:
+                if sent_message and len(response_text) + len(chunk_text) > DISCORD_MESSAGE_LENGTH_LIMIT - 3:
                     logger.info("on_message: Envoi du message actuel car le prochain chunk ferait dépasser la limite")
                     await sent_message.edit(content=response_text)
                     sent_message = await message.channel.send("...")
                     response_text = ""
             
-                response_text += chunk.text
+                response_text += chunk_text
             
                 if sent_message:
                     if len(response_text) <= DISCORD_MESSAGE_LENGTH_LIMIT - 3:
@@ -212,7 +230,7 @@ class BotCommands(commands.Cog):
 
         # Ajouter la réponse au contexte
             logger.info(f"on_message: Ajout de la réponse au contexte: {response_text}")
-            context.add_message("model", response_text)
+            context.add_message("model", response_text, model=response.model)
 
         except Exception as e:
             logger.error(f"on_message: Une erreur est survenue: {e}")
@@ -257,17 +275,29 @@ class BotCommands(commands.Cog):
         else:
             await ctx.send("Le bot n'est pas actif dans ce channel.")
 
-    @commands.command(name="download", help="Télécharge le contexte du channel courant.")
-    async def download(self, ctx):
+    @commands.command(name="download", help="Télécharge le contexte du channel courant : ?download [jsonl|md] [since=2024-12-01] [until=2024-12-31] [range=debut:fin]. Le format est optionnel, par exemple ?download since=2024-12-01.")
+    async def download(self, ctx, *args: str):
         logger.info(f"'download' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
         context = get_channel_context(ctx.channel.id)
         if context:
-            context_str = context.download_context()
-            with open("context.txt", "w", encoding="utf-8") as f:
-                f.write(context_str)
-            with open("context.txt", "rb") as f:
-                await ctx.send(file=discord.File(f, "context.txt"))
-            os.remove("context.txt")
+            # Le format est optionnel: un premier argument contenant '=' est déjà un filtre
+            fmt, filters = ("jsonl", args) if not args or "=" in args[0] else (args[0], args[1:])
+            try:
+                part_size = ctx.guild.filesize_limit if ctx.guild else DISCORD_DEFAULT_FILESIZE_LIMIT
+                files = await asyncio.to_thread(context.download_context, fmt, part_size, **parse_filters(filters))
+            except ValueError as e:
+                await ctx.send(f"Erreur : {e}")
+                return
+            if not files:
+                await ctx.send("Aucun message ne correspond à ces filtres.")
+                return
+            try:
+                # La limite d'upload s'applique à la requête entière, pas à chaque fichier
+                for batch in group_parts(files, part_size, DISCORD_MAX_FILES_PER_MESSAGE):
+                    await ctx.send(files=[discord.File(fp, filename) for filename, fp in batch])
+            finally:
+                for _, fp in files:
+                    fp.close()
         else:
             await ctx.send("Le bot n'est pas actif dans ce channel.")
 
@@ -286,18 +316,87 @@ class BotCommands(commands.Cog):
         logger.info(f"'set_context_size' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
         context = get_channel_context(ctx.channel.id)
         if context:
-            context.set_context_size(new_context_size)
-            await ctx.send(f"Taille maximale du contexte mise à jour pour ce channel : {new_context_size} tokens.")
+            effective_size = context.set_context_size(new_context_size)
+            if effective_size < new_context_size:
+                await ctx.send(f"Taille maximale du contexte mise à jour pour ce channel : {effective_size} tokens (limite du modèle {context.model_name}).")
+            else:
+                await ctx.send(f"Taille maximale du contexte mise à jour pour ce channel : {new_context_size} tokens.")
         else:
             await ctx.send("Le bot n'est pas actif dans ce channel.")
 
+    @commands.command(name="set_compaction", help="Active la compaction du contexte par résumé (seuil et taille conservée en tokens) ou la désactive avec 'off'.")
+    async def set_compaction(self, ctx, threshold: str, keep: int = None):
+        logger.info(f"'set_compaction' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        context = get_channel_context(ctx.channel.id)
+        if not context:
+            await ctx.send("Le bot n'est pas actif dans ce channel.")
+            return
+        if threshold.lower() == "off":
+            context.set_compaction(False)
+            await ctx.send("Compaction du contexte désactivée pour ce channel.")
+            return
+        if not threshold.isdigit():
+            await ctx.send("Erreur : le seuil doit être un nombre de tokens ou 'off'.")
+            return
+        context.set_compaction(True, int(threshold), keep)
+        await ctx.send(f"Compaction du contexte activée pour ce channel : résumé des anciens messages au-delà de {context.compaction_threshold} tokens, {context.compaction_keep} tokens d'historique récent conservés.")
+
+    @commands.command(name="set_media_aging", help="Remplace les médias par leur transcription après N messages et/ou T tokens (0 désactive la limite).")
+    async def set_media_aging(self, ctx, max_age_turns: int, max_age_tokens: int = 0):
+        logger.info(f"'set_media_aging' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        context = get_channel_context(ctx.channel.id)
+        if context:
+            context.set_media_aging(max_age_turns, max_age_tokens)
+            await ctx.send(f"Vieillissement des médias mis à jour pour ce channel : {max_age_turns or 'pas de limite de'} messages, {max_age_tokens or 'pas de limite de'} tokens.")
+        else:
+            await ctx.send("Le bot n'est pas actif dans ce channel.")
+
+    @commands.command(name="set_retrieval", help="Active ('on') ou désactive ('off') le mode recherche : fenêtre récente (messages) et nombre d'échanges passés rappelés.")
+    async def set_retrieval(self, ctx, mode: str, window: int = None, top_k: int = None):
+        logger.info(f"'set_retrieval' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        context = get_channel_context(ctx.channel.id)
+        if not context:
+            await ctx.send("Le bot n'est pas actif dans ce channel.")
+            return
+        if mode.lower() not in ("on", "off"):
+            await ctx.send("Erreur : le mode doit être 'on' ou 'off'.")
+            return
+        await asyncio.to_thread(context.set_retrieval, mode.lower() == "on", window, top_k)
+        if context.retrieval_index:
+            await ctx.send(f"Mode recherche activé pour ce channel : {context.retrieval_window} messages récents et jusqu'à {context.retrieval_top_k} échanges passés pertinents par requête.")
+        else:
+            await ctx.send("Mode recherche désactivé pour ce channel.")
+
+    @commands.command(name="set_prompt_cache", help="Active ('on') ou désactive ('off') le cache serveur du prompt système et de l'historique stable.")
+    async def set_prompt_cache(self, ctx, mode: str):
+        logger.info(f"'set_prompt_cache' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        context = get_channel_context(ctx.channel.id)
+        if not context:
+            await ctx.send("Le bot n'est pas actif dans ce channel.")
+            return
+        if mode.lower() not in ("on", "off"):
+            await ctx.send("Erreur : le mode doit être 'on' ou 'off'.")
+            return
+        context.set_prompt_cache(mode.lower() == "on")
+        if context.prompt_cache and context.retrieval_index:
+            await ctx.send("Cache de prompt activé, mais inutilisé tant que le mode recherche est actif (le début du contexte change à chaque requête).")
+        elif context.prompt_cache:
+            await ctx.send("Cache de prompt activé pour ce channel.")
+        else:
+            await ctx.send("Cache de prompt désactivé pour ce channel.")
+
     @commands.command(name="set_model", help="Change le modèle utilisé pour ce channel.")
     async def set_model(self, ctx, new_model: str):
         logger.info(f"'set_model' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
         context = get_channel_context(ctx.channel.id)
         if context:
+            await asyncio.to_thread(model_registry.refresh_if_unknown, new_model)
+            error = model_registry.validate(new_model)
+            if error:
+                await ctx.send(f"Erreur : {error}")
+                return
             context.set_model(new_model)
-            await ctx.send(f"Modèle mis à jour pour ce channel : {new_model}")
+            await ctx.send(f"Modèle mis à jour pour ce channel : {new_model} (taille du contexte : {context.context_size} tokens)")
         else:
             await ctx.send("Le bot n'est pas actif dans ce channel.")
 
@@ -306,7 +405,7 @@ class BotCommands(commands.Cog):
         logger.info(f"'info' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
         context = get_channel_context(ctx.channel.id)
         if context:
-            await ctx.send(f"Voici les paramètres utilisés par Ruber dans ce channel:\n- Prompt Système: {context.system_prompt}\n- Modèle: {context.model_name}\n- Taille du contexte: {context.context_size} tokens")
+            await ctx.send(f"Voici les paramètres utilisés par Ruber dans ce channel:\n- Prompt Système: {context.system_prompt}\n- Modèle: {context.model_name}\n- Taille du contexte: {context.context_size} tokens\n- Compaction: {f'au-delà de {context.compaction_threshold} tokens' if context.compaction_enabled else 'désactivée'}\n- Mode recherche: {f'{context.retrieval_window} messages récents + {context.retrieval_top_k} rappels' if context.retrieval_index else 'désactivé'}\n- Cache de prompt: {'activé' if context.prompt_cache else 'désactivé'}")
         else:
             await ctx.send("Le bot n'est pas actif dans ce channel.")
 
@@ -316,31 +415,63 @@ class BotCommands(commands.Cog):
         if ":" not in aspect_ratio:
             await ctx.send("Erreur : Le format de l'aspect ratio doit être 'nombre:nombre'. Par exemple : '1:1', '3:4', '16:9'.")
             return
-        await ctx.send("Génération de l'image en cours...")
-        try:
-            result = generate_images(prompt, aspect_ratio=aspect_ratio, negative_prompt=negative_prompt)
-            for i, image in enumerate(result.images):
-                with io.BytesIO() as image_binary:
-                    image.save(image_binary, 'PNG')
-                    image_binary.seek(0)
-                    if len(result.images) > 1:
-                        await ctx.send(f"Image {i+1} sur {len(result.images)}:", file=discord.File(fp=image_binary, filename=f'image_{i+1}.png'))
-                    else:
-                        await ctx.send(file=discord.File(fp=image_binary, filename='image.png'))
-        except Exception as e:
-            error_message = handle_api_error(e)
-            await ctx.send(f"Erreur lors de la génération de l'image : {error_message}")
+        images = imagen_queue.get_cached(prompt, aspect_ratio, negative_prompt)
+        if images is None:
+            status_message = await ctx.send("Génération de l'image en cours...")
 
-    @commands.command(name="debug_listmodels", help="Liste les modèles Gemini disponibles et leurs méthodes supportées.")
-    async def debug_listmodels(self, ctx):
+            async def on_position(position):
+                if position:
+                    await status_message.edit(content=f"Génération #{job.id} en file d'attente (position {position}). Annulation : `?imagen_cancel {job.id}`")
+                else:
+                    await status_message.edit(content=f"Génération #{job.id} en cours...")
+
+            guild_id = ctx.guild.id if ctx.guild else ctx.channel.id
+            job = imagen_queue.submit(guild_id, ctx.author.id, prompt, aspect_ratio, negative_prompt, on_position=on_position)
+            job.last_position = imagen_queue.position(job)
+            await on_position(job.last_position)
+            try:
+                images = await job.task
+            except asyncio.CancelledError:
+                await status_message.edit(content=f"Génération #{job.id} annulée.")
+                return
+            except Exception as e:
+                error_message = handle_api_error(e)
+                await ctx.send(f"Erreur lors de la génération de l'image : {error_message}")
+                return
+        if not images:
+            await ctx.send("Aucune image n'a été générée.")
+            return
+        # Toutes les images dans un seul message
+        for start in range(0, len(images), DISCORD_MAX_FILES_PER_MESSAGE):
+            files = [discord.File(fp=io.BytesIO(data), filename=f'image_{i + 1}.png')
+                     for i, data in enumerate(images[start:start + DISCORD_MAX_FILES_PER_MESSAGE], start)]
+            await ctx.send(files=files)
+
+    @commands.command(name="imagen_cancel", help="Annule une génération d'image (par défaut la plus récente de l'utilisateur).")
+    async def imagen_cancel(self, ctx, job_id: int = None):
+        logger.info(f"'imagen_cancel' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        if job_id is None:
+            jobs = imagen_queue.get_author_jobs(ctx.author.id)
+            if not jobs:
+                await ctx.send("Vous n'avez aucune génération en cours.")
+                return
+            job_id = jobs[-1].id
+        if not imagen_queue.cancel(job_id, ctx.author.id):
+            await ctx.send(f"Aucune génération #{job_id} à votre nom.")
+
+    @commands.command(name="debug_listmodels", help="Liste les modèles Gemini disponibles et leurs méthodes supportées ('refresh' pour recharger le catalogue).")
+    async def debug_listmodels(self, ctx, action: str = None):
         logger.info(f"'debug_listmodels' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
         try:
-            models_info = list_models()
+            if not model_registry.models or action == "refresh":
+                await asyncio.to_thread(model_registry.refresh)
+            models_info = model_registry.list()
             response_text = "Modèles disponibles:\n"
             for model in models_info:
-                response_text += f"- **{model.name}**\n"
-                response_text += f"  - Description: {model.description}\n"
-                response_text += f"  - Méthodes supportées: {', '.join(model.supported_generation_methods)}\n"
+                response_text += f"- **{model['name']}**\n"
+                response_text += f"  - Description: {model['description']}\n"
+                response_text += f"  - Tokens: {model['input_token_limit']} en entrée, {model['output_token_limit']} en sortie\n"
+                response_text += f"  - Méthodes supportées: {', '.join(model['supported_generation_methods'])}\n"
             if len(response_text) > DISCORD_MESSAGE_LENGTH_LIMIT:
                 for i in range(0, len(response_text), DISCORD_MESSAGE_LENGTH_LIMIT):
                     await ctx.send(response_text[i:i + DISCORD_MESSAGE_LENGTH_LIMIT])
@@ -350,6 +481,25 @@ class BotCommands(commands.Cog):
             error_message = handle_api_error(e)
             await ctx.send(f"Erreur lors de la récupération des modèles : {error_message}")
 
+    @commands.command(name="debug_lag", help="Affiche les appels qui bloquent la boucle asyncio ('dump' pour le fichier complet, 'reset' pour remettre à zéro).")
+    async def debug_lag(self, ctx, action: str = None):
+        logger.info(f"'debug_lag' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        if action == "reset":
+            loop_monitor.reset()
+            await ctx.send("Statistiques de blocage remises à zéro.")
+            return
+        response_text = loop_monitor.format_report()
+        for i in range(0, len(response_text), DISCORD_MESSAGE_LENGTH_LIMIT):
+            await ctx.send(response_text[i:i + DISCORD_MESSAGE_LENGTH_LIMIT])
+        if action == "dump":
+            dump_path = loop_monitor.dump()
+            await ctx.send(file=discord.File(dump_path, os.path.basename(dump_path)))
+
+    @commands.command(name="debug_latency", help="Affiche le temps moyen avant le premier chunk de chaque modèle.")
+    async def debug_latency(self, ctx):
+        logger.info(f"'debug_latency' command exécutée par {ctx.author} dans le channel {ctx.channel.id}")
+        await ctx.send(model_router.format_stats())
+
     @commands.command(name="tts", help="Active/désactive la lecture vocale des réponses du bot.")
     async def tts(self, ctx):
         """Active ou désactive le TTS pour ce canal."""
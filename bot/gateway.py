@@ -0,0 +1,42 @@
+import discord
+
+def get_intents(low_memory=False):
+    """Gateway intents needed by BotCommands.
+
+    The low memory profile only subscribes to guild/DM messages (with their content)
+    and voice states, so reactions, typing, emojis, invites, etc. are neither received
+    nor cached.
+    """
+    if not low_memory:
+        intents = discord.Intents.default()
+        intents.message_content = True
+        intents.voice_states = True
+        return intents
+    return discord.Intents(
+        guilds=True,
+        guild_messages=True,
+        dm_messages=True,
+        message_content=True,
+        voice_states=True,
+    )
+
+def get_bot_options(low_memory=False):
+    """Keyword arguments for commands.Bot.
+
+    In the low memory profile the message cache is disabled (replies are edited through
+    the Message objects returned by send), only members currently in a voice channel are
+    cached (ctx.author.voice and voice recording), and guilds are never chunked at startup.
+    The default intents already exclude the privileged members intent, so py-cord already
+    caches only voice members and skips chunking in the default profile: the member options
+    only make that explicit, and the saving comes from the message cache and the intents.
+    """
+    options = {"command_prefix": "?", "intents": get_intents(low_memory)}
+    if low_memory:
+        member_cache_flags = discord.MemberCacheFlags.none()
+        member_cache_flags.voice = True
+        options.update(
+            max_messages=None,
+            member_cache_flags=member_cache_flags,
+            chunk_guilds_at_startup=False,
+        )
+    return options
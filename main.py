@@ -1,13 +1,15 @@
 import argparse
 import logging
-import discord
 from discord.ext import commands
-from utils.config import get_discord_bot_token
+from utils.config import get_discord_bot_token, get_low_memory_profile
 from bot.bot import setup_bot
+from bot.gateway import get_bot_options
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"])
+    parser.add_argument("--low-memory", action="store_true", default=get_low_memory_profile(),
+                        help="Désactive le cache des messages, limite le cache des membres et ne charge pas les membres des serveurs au démarrage")
     args = parser.parse_args()
 
     numeric_level = getattr(logging, args.log_level.upper(), None)
@@ -15,10 +17,7 @@ if __name__ == "__main__":
         raise ValueError(f'Invalid log level: {args.log_level}')
     logging.basicConfig(level=numeric_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    intents = discord.Intents.default()
-    intents.message_content = True
-    intents.voice_states = True
-    bot = commands.Bot(command_prefix="?", intents=intents)
+    bot = commands.Bot(**get_bot_options(args.low_memory))
 
     setup_bot(bot)
 
@@ -28,18 +28,21 @@ async def leave_voice_channel(guild_id, voice_clients):
         except Exception as e:
             logger.error(f"Erreur lors de la déconnexion du canal vocal: {e}")
 
+def synthesize_speech(text):
+    """Renvoie le flux de chunks mp3 de la synthèse vocale ElevenLabs."""
+    elevenlabs_client = ElevenLabs(api_key=get_elevenlabs_api_key())
+    return elevenlabs_client.text_to_speech.convert_as_stream(
+        text=text,
+        voice_id=get_elevenlabs_voice_id(),
+        model_id=get_elevenlabs_model_id(),
+        output_format="mp3_44100_128"
+    )
+
 async def play_tts(voice_client, text):
     """Joue le texte en TTS dans le canal vocal."""
     try:
         temp_file = io.BytesIO()
-        elevenlabs_client = ElevenLabs(api_key=get_elevenlabs_api_key())
-        audio_stream = elevenlabs_client.text_to_speech.convert_as_stream(
-            text=text,
-            voice_id=get_elevenlabs_voice_id(),
-            model_id=get_elevenlabs_model_id(),
-            output_format="mp3_44100_128"
-        )
-        for chunk in audio_stream:
+        for chunk in synthesize_speech(text):
             if isinstance(chunk, bytes):
                 temp_file.write(chunk)
         temp_file.seek(0)
@@ -31,3 +31,75 @@ def get_elevenlabs_voice_id():
 
 def get_elevenlabs_model_id():
     return os.getenv("ELEVENLABS_MODEL_ID")
+
+def get_loop_lag_monitor_enabled():
+    return os.getenv("LOOP_LAG_MONITOR", "true").lower() in ("1", "true", "yes")
+
+def get_loop_lag_threshold():
+    return float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+
+def get_loop_lag_dump_file():
+    return os.getenv("LOOP_LAG_DUMP_FILE", "loop_lag.json")
+
+def get_context_compaction_enabled():
+    return os.getenv("CONTEXT_COMPACTION", "false").lower() in ("1", "true", "yes")
+
+def get_context_compaction_threshold():
+    return int(os.getenv("CONTEXT_COMPACTION_THRESHOLD", "131072"))
+
+def get_context_compaction_keep():
+    return int(os.getenv("CONTEXT_COMPACTION_KEEP", "32768"))
+
+def get_media_max_age_turns():
+    return int(os.getenv("MEDIA_MAX_AGE_TURNS", "0"))
+
+def get_media_max_age_tokens():
+    return int(os.getenv("MEDIA_MAX_AGE_TOKENS", "0"))
+
+def get_imagen_max_concurrent():
+    return int(os.getenv("IMAGEN_MAX_CONCURRENT", "2"))
+
+def get_imagen_max_per_guild():
+    return int(os.getenv("IMAGEN_MAX_PER_GUILD", "1"))
+
+def get_imagen_cache_size():
+    return int(os.getenv("IMAGEN_CACHE_SIZE", "16"))
+
+def get_model_catalogue_file():
+    return os.getenv("MODEL_CATALOGUE_FILE", "models_cache.json")
+
+def get_model_catalogue_ttl():
+    return int(os.getenv("MODEL_CATALOGUE_TTL", "86400"))
+
+def get_fallback_model():
+    return os.getenv("FALLBACK_MODEL") or None
+
+def get_hedge_deadline():
+    return float(os.getenv("HEDGE_DEADLINE", "5.0"))
+
+def get_retrieval_enabled():
+    return os.getenv("RETRIEVAL_MODE", "false").lower() in ("1", "true", "yes")
+
+def get_retrieval_window():
+    return int(os.getenv("RETRIEVAL_WINDOW", "20"))
+
+def get_retrieval_top_k():
+    return int(os.getenv("RETRIEVAL_TOP_K", "5"))
+
+def get_retrieval_embedder():
+    return os.getenv("RETRIEVAL_EMBEDDER", "hashing")
+
+def get_low_memory_profile():
+    return os.getenv("LOW_MEMORY_PROFILE", "false").lower() in ("1", "true", "yes")
+
+def get_prompt_cache_enabled():
+    return os.getenv("PROMPT_CACHE", "false").lower() in ("1", "true", "yes")
+
+def get_prompt_cache_min_tokens():
+    return int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "32768"))
+
+def get_prompt_cache_ttl():
+    return int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+
+def get_prompt_cache_refresh_tokens():
+    return int(os.getenv("PROMPT_CACHE_REFRESH_TOKENS", "32768"))
@@ -2,27 +2,81 @@ import os
 import json
 import logging
 import base64
-from utils.config import get_default_context_size, get_default_system_prompt, get_default_model
-from utils.gemini import count_tokens
+import hashlib
+import mimetypes
+import threading
+import time
+from utils.config import (
+    get_default_context_size, get_default_system_prompt, get_default_model,
+    get_context_compaction_enabled, get_context_compaction_threshold, get_context_compaction_keep,
+    get_media_max_age_turns, get_media_max_age_tokens,
+    get_retrieval_enabled, get_retrieval_window, get_retrieval_top_k, get_retrieval_embedder,
+    get_prompt_cache_enabled, get_prompt_cache_min_tokens, get_prompt_cache_ttl, get_prompt_cache_refresh_tokens
+)
+from utils.gemini import count_tokens, summarize_messages, describe_media
+from utils.models import model_registry
+from utils.export import export_messages
+from utils.retrieval import RetrievalIndex, HashingEmbedder, GeminiEmbedder, message_text
+from utils.prompt_cache import PromptCache
 
 logger = logging.getLogger(__name__)
 
+SUMMARY_PREFIX = "[Mémoire de la conversation] "
+RECALL_PREFIX = "[Souvenirs pertinents d'échanges plus anciens]"
+RECALL_MAX_CHARS = 1000
+MEDIA_LABELS = {"audio": "Audio", "image": "Image", "video": "Vidéo"}
+MEDIA_MAX_ATTEMPTS = 3
+
 class ContextManager:
     """Manages conversation context and message history with token caching"""
-    
+
     def __init__(self, channel_id, system_prompt=None):
         self.channel_id = channel_id
         self.contexts_dir = "contexts"
         self.context_file = os.path.join(self.contexts_dir, f"{channel_id}.json")
         self._ensure_contexts_directory()
-        
+
         self.system_prompt = system_prompt or get_default_system_prompt()
         self.model_name = get_default_model()
-        self.context_size = get_default_context_size()
-        
+        # La taille effective (context_size) est plafonnée à la fenêtre d'entrée du modèle,
+        # recalculée à chaque lecture puisque le catalogue peut arriver après la création
+        self.requested_context_size = get_default_context_size()
+
+        # Compaction: au-delà du seuil, les plus anciens messages sont résumés en tâche de fond
+        # jusqu'à ce qu'il ne reste que `compaction_keep` tokens d'historique brut
+        self.compaction_enabled = get_context_compaction_enabled()
+        self.compaction_threshold = get_context_compaction_threshold()
+        self.compaction_keep = get_context_compaction_keep()
+        self._compaction_thread = None
+
+        # Vieillissement des médias: au-delà de N messages ou T tokens plus récents (0 = désactivé),
+        # un média est remplacé par sa transcription/description, l'original restant sur disque
+        self.media_max_age_turns = get_media_max_age_turns()
+        self.media_max_age_tokens = get_media_max_age_tokens()
+        self.media_dir = os.path.join(self.contexts_dir, "media", str(channel_id))
+        self.media_descriptions_file = os.path.join(self.media_dir, "descriptions.json")
+        self._media_thread = None
+        # Structure: {sha256 des données base64: nombre d'échecs}
+        self._media_failures = {}
+
+        # Mode recherche: seuls les `retrieval_window` derniers messages sont envoyés,
+        # complétés par les `retrieval_top_k` échanges passés les plus pertinents
+        self.retrieval_window = get_retrieval_window()
+        self.retrieval_top_k = get_retrieval_top_k()
+        self.retrieval_index = None
+
+        # Cache serveur du system prompt et de l'historique stable, seul le suffixe est envoyé
+        self.prompt_cache = None
+        if get_prompt_cache_enabled():
+            self.set_prompt_cache(True)
+        self._lock = threading.RLock()
+
         # Structure: {"messages": [...], "token_counts": [...], "total_tokens": int}
+        # messages[1] peut être un résumé ({"role": "user", "parts": [...], "summary": True})
         self.context_data = self._load_context()
-        
+        if get_retrieval_enabled():
+            self.set_retrieval(True)
+
     def _ensure_contexts_directory(self):
         """Ensure the contexts directory exists"""
         os.makedirs(self.contexts_dir, exist_ok=True)
@@ -40,12 +94,12 @@ class ContextManager:
                         "token_counts": token_counts,
                         "total_tokens": sum(token_counts)
                     }
-                
+
                 # S'assurer que le premier message est le system prompt
                 data["messages"][0] = {"role": "system", "parts": [self.system_prompt]}
                 data["token_counts"][0] = count_tokens(self.system_prompt, self.model_name)
                 data["total_tokens"] = sum(data["token_counts"])
-                
+
                 return data
         except (FileNotFoundError, json.JSONDecodeError):
             # Créer un nouveau contexte
@@ -58,11 +112,12 @@ class ContextManager:
 
     def save_context(self):
         """Save current context to file"""
-        with open(self.context_file, "w", encoding="utf-8") as f:
-            json.dump(self.context_data, f, ensure_ascii=False, indent=2)
+        with self._lock:
+            with open(self.context_file, "w", encoding="utf-8") as f:
+                json.dump(self.context_data, f, ensure_ascii=False, indent=2)
 
-    def add_message(self, role, content):
-        """Add a message to the context with token counting"""
+    def add_message(self, role, content, model=None):
+        """Add a message to the context with token counting; `model` records which model wrote a reply"""
         if isinstance(content, str):
             content = [content]
         elif isinstance(content, list):
@@ -83,37 +138,267 @@ class ContextManager:
                     encoded_content.append(item)
             content = encoded_content
 
-        message = {"role": role, "parts": content}
+        message = {"role": role, "parts": content, "timestamp": time.time()}
+        if model:
+            message["model"] = model
         message_tokens = count_tokens(content[0], self.model_name)
 
-        self.context_data["messages"].append(message)
-        self.context_data["token_counts"].append(message_tokens)
-        self.context_data["total_tokens"] += message_tokens
+        with self._lock:
+            self.context_data["messages"].append(message)
+            self.context_data["token_counts"].append(message_tokens)
+            self.context_data["total_tokens"] += message_tokens
 
-        self._trim_context()
-        self.save_context()
+            self._trim_context()
+            self.save_context()
+        if self.retrieval_index:
+            self._index_in_background([message])
+        self._age_media()
+        self._maybe_compact()
+
+    def _history_start(self):
+        """Index of the first raw history message (after the system prompt and the summary, if any)"""
+        messages = self.context_data["messages"]
+        if len(messages) > 1 and messages[1].get("summary"):
+            return 2
+        return 1
+
+    def get_summary(self):
+        """Get the current long-term memory summary, or None"""
+        with self._lock:
+            if self._history_start() == 2:
+                return self.context_data["messages"][1]["parts"][0][len(SUMMARY_PREFIX):]
+            return None
 
     def _trim_context(self):
-        """Trim context when it exceeds the token limit using cached token counts"""
-        while (self.context_data["total_tokens"] > self.context_size and 
-               len(self.context_data["messages"]) > 1):
-            self.context_data["total_tokens"] -= self.context_data["token_counts"][1]
-            self.context_data["messages"].pop(1)
-            self.context_data["token_counts"].pop(1)
+        """Trim context when it exceeds the token limit using cached token counts.
+
+        With a prompt cache, a whole block (up to `refresh_tokens`) is trimmed at once, so the
+        cached prefix changes once per block instead of on every new message.
+        """
+        with self._lock:
+            start = self._history_start()
+            limit = self.context_size
+            prompt_cache = self.get_prompt_cache()
+            if prompt_cache and self.context_data["total_tokens"] > limit:
+                limit -= min(prompt_cache.refresh_tokens, limit // 2)
+            while (self.context_data["total_tokens"] > limit and
+                   len(self.context_data["messages"]) > start):
+                self.context_data["total_tokens"] -= self.context_data["token_counts"][start]
+                self.context_data["messages"].pop(start)
+                self.context_data["token_counts"].pop(start)
+
+    def _maybe_compact(self):
+        """Start a background summarization of the oldest turns once the high-water mark is crossed"""
+        with self._lock:
+            if not self.compaction_enabled or self.context_data["total_tokens"] <= self.compaction_threshold:
+                return
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                return
+
+            start = self._history_start()
+            messages = self.context_data["messages"]
+            token_counts = self.context_data["token_counts"]
+            remaining = sum(token_counts[start:])
+            end = start
+            # On garde toujours au moins le dernier échange intact
+            while end < len(messages) - 2 and remaining > self.compaction_keep:
+                remaining -= token_counts[end]
+                end += 1
+            span = messages[start:end]
+            if not span:
+                return
+
+            previous_summary = self.get_summary()
+            self._compaction_thread = threading.Thread(
+                target=self._compact, args=(span, previous_summary, self.model_name),
+                name=f"compaction-{self.channel_id}", daemon=True
+            )
+            self._compaction_thread.start()
+
+    def _compact(self, span, previous_summary, model_name):
+        """Summarize `span` and replace it with the updated memory message"""
+        try:
+            summary = summarize_messages(span, previous_summary, model_name)
+            summary_text = SUMMARY_PREFIX + summary
+            summary_tokens = count_tokens(summary_text, model_name)
+        except Exception as e:
+            logger.error(f"Erreur lors de la compaction du contexte du channel {self.channel_id}: {e}")
+            return
+
+        with self._lock:
+            start = self._history_start()
+            messages = self.context_data["messages"]
+            current = messages[start:start + len(span)]
+            # Le contexte a pu être vidé, élagué ou modifié pendant la génération du résumé
+            if len(current) != len(span) or any(a is not b for a, b in zip(current, span)):
+                logger.info(f"Compaction du channel {self.channel_id} abandonnée: le contexte a changé entre-temps")
+                return
+
+            removed_tokens = sum(self.context_data["token_counts"][start:start + len(span)])
+            del messages[start:start + len(span)]
+            del self.context_data["token_counts"][start:start + len(span)]
+            self.context_data["total_tokens"] -= removed_tokens
+
+            summary_message = {"role": "user", "parts": [summary_text], "summary": True}
+            if start == 2:
+                self.context_data["total_tokens"] -= self.context_data["token_counts"][1]
+                messages[1] = summary_message
+                self.context_data["token_counts"][1] = summary_tokens
+            else:
+                messages.insert(1, summary_message)
+                self.context_data["token_counts"].insert(1, summary_tokens)
+            self.context_data["total_tokens"] += summary_tokens
+            self.save_context()
+        logger.info(f"Compaction du channel {self.channel_id}: {len(span)} messages ({removed_tokens} tokens) résumés en {summary_tokens} tokens")
+
+    @staticmethod
+    def _is_media(part):
+        return isinstance(part, dict) and "data" in part and part.get("mime_type") != "text/plain"
+
+    def _age_media(self):
+        """Start a background replacement of media parts that are older than the aging policy"""
+        with self._lock:
+            if not self.media_max_age_turns and not self.media_max_age_tokens:
+                return
+            if self._media_thread and self._media_thread.is_alive():
+                return
+
+            messages = self.context_data["messages"]
+            token_counts = self.context_data["token_counts"]
+            expired = []
+            newer_tokens = 0
+            for index in range(len(messages) - 1, self._history_start() - 1, -1):
+                newer_turns = len(messages) - 1 - index
+                too_old = ((self.media_max_age_turns and newer_turns >= self.media_max_age_turns) or
+                           (self.media_max_age_tokens and newer_tokens >= self.media_max_age_tokens))
+                if too_old:
+                    message = messages[index]
+                    expired.extend((message, i, part) for i, part in enumerate(message["parts"]) if self._is_media(part))
+                newer_tokens += token_counts[index]
+            if not expired:
+                return
+
+            self._media_thread = threading.Thread(
+                target=self._replace_media, args=(expired, self.model_name),
+                name=f"media-aging-{self.channel_id}", daemon=True
+            )
+            self._media_thread.start()
+
+    def _load_media_descriptions(self):
+        try:
+            with open(self.media_descriptions_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _archive_media(self, part):
+        """Write the original media to disk once and return (digest, path)"""
+        data = base64.b64decode(part["data"])
+        digest = hashlib.sha256(data).hexdigest()
+        extension = mimetypes.guess_extension(part["mime_type"]) or "." + part["mime_type"].split("/")[-1]
+        path = os.path.join(self.media_dir, digest + extension)
+        if not os.path.exists(path):
+            os.makedirs(self.media_dir, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        return digest, path
+
+    def _replace_media(self, expired, model_name):
+        """Replace expired media parts by their cached text stand-in"""
+        descriptions = self._load_media_descriptions()
+        replacements = []
+        for message, index, part in expired:
+            path = None
+            try:
+                digest, path = self._archive_media(part)
+                if digest not in descriptions:
+                    descriptions[digest] = describe_media(part, model_name)
+                    with open(self.media_descriptions_file, "w", encoding="utf-8") as f:
+                        json.dump(descriptions, f, ensure_ascii=False, indent=2)
+                description = descriptions[digest]
+            except Exception as e:
+                key = hashlib.sha256(str(part["data"]).encode("utf-8")).hexdigest()
+                failures = self._media_failures.get(key, 0) + 1
+                logger.error(f"Erreur lors du vieillissement d'un média du channel {self.channel_id} (tentative {failures}/{MEDIA_MAX_ATTEMPTS}): {e}")
+                if failures < MEDIA_MAX_ATTEMPTS:
+                    self._media_failures[key] = failures
+                    continue
+                # Un média qui échoue toujours (type non supporté, trop gros...) n'est plus retenté
+                self._media_failures.pop(key, None)
+                description = "(description indisponible)"
+            label = MEDIA_LABELS.get(part["mime_type"].split("/")[0], "Document")
+            location = f"archivé: {path}" if path else "non archivé"
+            text_part = {"text": f"[{label} {location}] {description}"}
+            # Seul le premier élément d'un message compte dans token_counts
+            new_tokens = count_tokens(text_part, model_name) if index == 0 else None
+            replacements.append((message, index, part, text_part, new_tokens))
+
+        transcribed = []
+        with self._lock:
+            messages = self.context_data["messages"]
+            for message, index, part, text_part, new_tokens in replacements:
+                # Le message a pu être élagué, résumé ou effacé entre-temps
+                position = next((i for i, m in enumerate(messages) if m is message), None)
+                if position is None or index >= len(message["parts"]) or message["parts"][index] is not part:
+                    continue
+                if not message_text(message).strip():
+                    transcribed.append(message)
+                message["parts"][index] = text_part
+                if new_tokens is not None:
+                    self.context_data["total_tokens"] += new_tokens - self.context_data["token_counts"][position]
+                    self.context_data["token_counts"][position] = new_tokens
+            self.save_context()
+        # Les messages sans texte (vocaux) deviennent indexables une fois transcrits
+        if self.retrieval_index and transcribed:
+            self.retrieval_index.add(transcribed)
+        if replacements:
+            logger.info(f"Vieillissement des médias du channel {self.channel_id}: {len(replacements)} médias remplacés par leur transcription")
 
     def clear_context(self):
         """Clear context except system prompt"""
-        system_tokens = self.context_data["token_counts"][0]
-        self.context_data = {
-            "messages": [self.context_data["messages"][0]],
-            "token_counts": [system_tokens],
-            "total_tokens": system_tokens
-        }
-        self.save_context()
+        with self._lock:
+            system_tokens = self.context_data["token_counts"][0]
+            self.context_data = {
+                "messages": [self.context_data["messages"][0]],
+                "token_counts": [system_tokens],
+                "total_tokens": system_tokens
+            }
+            self.save_context()
+        if self.retrieval_index:
+            self.retrieval_index.clear()
 
     def get_context(self):
-        """Get current context"""
-        return self.context_data["messages"]
+        """Get the full current context"""
+        with self._lock:
+            return list(self.context_data["messages"])
+
+    def get_request_context(self):
+        """Get the messages to send for the next request: the full context, or in retrieval mode
+        a recent window plus recalled turns (may embed the query, call it off the event loop)"""
+        with self._lock:
+            messages = list(self.context_data["messages"])
+            start = self._history_start()
+        if not self.retrieval_index or len(messages) - start <= self.retrieval_window:
+            return messages
+
+        recent = messages[len(messages) - self.retrieval_window:]
+        # La requête est le dernier message contenant du texte (en général celui de l'utilisateur)
+        query = next((message_text(message) for message in reversed(recent) if message_text(message).strip()), "")
+        recalled = self.retrieval_index.search(query, self.retrieval_top_k, before=recent[0].get("timestamp"))
+        if not recalled:
+            return messages[:start] + recent
+        lines = [RECALL_PREFIX]
+        for entry in recalled:
+            text = entry["text"][:RECALL_MAX_CHARS]
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["timestamp"])) if entry["timestamp"] else "date inconnue"
+            lines.append(f"- ({date}) {'Ruber' if entry['role'] == 'model' else 'Utilisateur'} : {text}")
+        return messages[:start] + [{"role": "user", "parts": ["\n".join(lines)]}] + recent
+
+    def download_context(self, fmt="jsonl", part_size=8 * 1024 * 1024, **filters):
+        """Export the context as compressed parts under `part_size` bytes (see utils.export)"""
+        with self._lock:
+            messages = list(self.context_data["messages"])
+        return export_messages(messages, f"context_{self.channel_id}", fmt, part_size, **filters)
 
     def get_token_count(self):
         """Get current total token count"""
@@ -123,32 +408,113 @@ class ContextManager:
         """Update system prompt with token recounting"""
         self.system_prompt = new_prompt
         new_tokens = count_tokens(new_prompt, self.model_name)
-        
-        self.context_data["total_tokens"] -= self.context_data["token_counts"][0]
-        self.context_data["total_tokens"] += new_tokens
-        
-        self.context_data["messages"][0] = {"role": "system", "parts": [self.system_prompt]}
-        self.context_data["token_counts"][0] = new_tokens
-        
-        self._trim_context()
-        self.save_context()
+
+        with self._lock:
+            self.context_data["total_tokens"] -= self.context_data["token_counts"][0]
+            self.context_data["total_tokens"] += new_tokens
+
+            self.context_data["messages"][0] = {"role": "system", "parts": [self.system_prompt]}
+            self.context_data["token_counts"][0] = new_tokens
+
+            self._trim_context()
+            self.save_context()
 
     def set_model(self, new_model):
         """Update model name with token recounting"""
         old_model = self.model_name
         self.model_name = new_model
-        
-        new_token_counts = [count_tokens(msg["parts"][0], new_model) 
-                          for msg in self.context_data["messages"]]
-        
-        self.context_data["token_counts"] = new_token_counts
-        self.context_data["total_tokens"] = sum(new_token_counts)
-        
-        self._trim_context()
-        self.save_context()
+
+        with self._lock:
+            new_token_counts = [count_tokens(msg["parts"][0], new_model)
+                              for msg in self.context_data["messages"]]
+
+            self.context_data["token_counts"] = new_token_counts
+            self.context_data["total_tokens"] = sum(new_token_counts)
+
+            self._trim_context()
+            self.save_context()
+
+    @property
+    def context_size(self):
+        """Requested context size, limited to the current model's input window when known"""
+        limit = model_registry.get_input_token_limit(self.model_name)
+        return min(self.requested_context_size, limit) if limit else self.requested_context_size
 
     def set_context_size(self, new_size):
-        """Update context size"""
-        self.context_size = new_size
+        """Update context size, clamped to the model's input window; returns the effective size"""
+        self.requested_context_size = new_size
         self._trim_context()
-        self.save_context()
\ No newline at end of file
+        self.save_context()
+        return self.context_size
+
+    def set_compaction(self, enabled, threshold=None, keep=None):
+        """Update the rolling summarization settings"""
+        self.compaction_enabled = enabled
+        if threshold is not None:
+            self.compaction_threshold = threshold
+        if keep is not None:
+            self.compaction_keep = keep
+        self._maybe_compact()
+
+    def set_retrieval(self, enabled, window=None, top_k=None):
+        """Enable or disable retrieval mode, indexing the existing history in the background on first use"""
+        if window is not None:
+            self.retrieval_window = window
+        if top_k is not None:
+            self.retrieval_top_k = top_k
+        if not enabled:
+            self.retrieval_index = None
+            return
+        if self.retrieval_index is None:
+            embedder = GeminiEmbedder() if get_retrieval_embedder() == "gemini" else HashingEmbedder()
+            index = RetrievalIndex(os.path.join(self.contexts_dir, f"{self.channel_id}.index.jsonl"), embedder)
+            first_use = not index.entries
+            with self._lock:
+                history = self.context_data["messages"][self._history_start():]
+            if not first_use:
+                # Rattrapage après un redémarrage: les messages non datés ne sont indexés qu'à la création
+                history = [message for message in history if message.get("timestamp") is not None]
+            self.retrieval_index = index
+            self._index_in_background(history)
+
+    def _index_in_background(self, messages):
+        """Add messages to the retrieval index without blocking the caller (embedding may be a network call)"""
+        index = self.retrieval_index
+
+        def run():
+            try:
+                index.add(messages)
+            except Exception as e:
+                logger.error(f"Erreur lors de l'indexation du channel {self.channel_id}: {e}")
+
+        threading.Thread(target=run, name=f"retrieval-index-{self.channel_id}", daemon=True).start()
+
+    def _count_message_tokens(self, messages):
+        """Cached token counts for messages of this context, estimated for the others"""
+        with self._lock:
+            known = {id(msg): count for msg, count in zip(self.context_data["messages"], self.context_data["token_counts"])}
+        return [known.get(id(msg), len(json.dumps(msg["parts"], ensure_ascii=False)) // 4) for msg in messages]
+
+    def set_prompt_cache(self, enabled):
+        """Enable or disable server-side prefix caching"""
+        if not enabled:
+            if self.prompt_cache:
+                threading.Thread(target=self.prompt_cache.invalidate, daemon=True).start()
+            self.prompt_cache = None
+        elif self.prompt_cache is None:
+            self.prompt_cache = PromptCache(
+                self._count_message_tokens,
+                min_tokens=get_prompt_cache_min_tokens(),
+                ttl=get_prompt_cache_ttl(),
+                refresh_tokens=get_prompt_cache_refresh_tokens()
+            )
+
+    def get_prompt_cache(self):
+        """Prompt cache to use for the next request, None when the prefix is not stable (retrieval mode)"""
+        return None if self.retrieval_index else self.prompt_cache
+
+    def set_media_aging(self, max_age_turns, max_age_tokens=0):
+        """Update the media aging policy (0 disables a limit)"""
+        self.media_max_age_turns = max_age_turns
+        self.media_max_age_tokens = max_age_tokens
+        self._age_media()
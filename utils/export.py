@@ -0,0 +1,142 @@
+import gzip
+import json
+import zlib
+import base64
+import hashlib
+import logging
+import tempfile
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SPOOL_MAX_SIZE = 1024 * 1024  # Au-delà, les parties sont écrites sur disque
+FLUSH_INTERVAL = 256 * 1024  # Octets non compressés entre deux flush du compresseur
+EXPORT_FORMATS = ("jsonl", "md")
+PART_OVERHEAD = 1024  # Marge par fichier pour l'enveloppe multipart de l'upload
+
+def parse_filters(tokens):
+    """Parse `since=<ISO date>`, `until=<ISO date>` and `range=<start>:<end>` export filters.
+
+    Raises ValueError with a user facing message on invalid input.
+    """
+    filters = {}
+    for token in tokens:
+        key, _, value = token.partition("=")
+        try:
+            if key in ("since", "until"):
+                filters[key] = datetime.fromisoformat(value).timestamp()
+            elif key == "range":
+                start, _, end = value.partition(":")
+                filters["start"] = int(start) if start else None
+                filters["end"] = int(end) if end else None
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Filtre invalide : '{token}'. Formats acceptés : since=2024-12-01, until=2024-12-31T18:00, range=10:50")
+    return filters
+
+def select_messages(messages, since=None, until=None, start=None, end=None):
+    """Yield (index, message) pairs matching the filters; time filters skip undated messages.
+
+    `start` and `end` follow slice semantics (negative values count from the end) and the
+    yielded indexes are always the real positions in `messages`.
+    """
+    for index in range(len(messages))[start:end]:
+        message = messages[index]
+        timestamp = message.get("timestamp")
+        if since is not None and (timestamp is None or timestamp < since):
+            continue
+        if until is not None and (timestamp is None or timestamp > until):
+            continue
+        yield index, message
+
+def _serialize_part(part):
+    """Keep text as is and replace inline media by a reference"""
+    if isinstance(part, dict) and "data" in part and part.get("mime_type") != "text/plain":
+        data = base64.b64decode(part["data"])
+        return {"mime_type": part["mime_type"], "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+    if isinstance(part, dict) and "text" in part:
+        return part["text"]
+    return part
+
+def _serialize_message(index, message):
+    record = {"index": index, "role": message["role"], "timestamp": message.get("timestamp")}
+    if message.get("model"):
+        record["model"] = message["model"]
+    if message.get("summary"):
+        record["summary"] = True
+    record["parts"] = [_serialize_part(part) for part in message["parts"]]
+    return record
+
+def _render_jsonl(record):
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+def _render_markdown(record):
+    date = datetime.fromtimestamp(record["timestamp"]).isoformat(sep=" ", timespec="seconds") if record["timestamp"] else "date inconnue"
+    title = f"### #{record['index']} {record['role']}"
+    if record.get("model"):
+        title += f" ({record['model']})"
+    lines = [f"{title} — {date}", ""]
+    for part in record["parts"]:
+        if isinstance(part, dict):
+            lines.append(f"*[{part['mime_type']}, {part['size']} octets, sha256:{part['sha256'][:12]}]*")
+        else:
+            lines.append(str(part))
+    return "\n".join(lines) + "\n\n"
+
+def export_messages(messages, name, fmt="jsonl", part_size=8 * 1024 * 1024, **filters):
+    """Stream the selected messages as gzip compressed parts of at most `part_size` bytes.
+
+    Returns a list of (filename, file object positioned at 0); the files are spooled
+    in memory and only overflow to a temporary file for large exports.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Format inconnu : '{fmt}'. Formats acceptés : {', '.join(EXPORT_FORMATS)}")
+    render = _render_jsonl if fmt == "jsonl" else _render_markdown
+
+    parts = []
+    raw = compressor = None
+    pending = 0
+
+    def close_part():
+        compressor.close()
+        raw.seek(0)
+
+    for index, message in select_messages(messages, **filters):
+        data = render(_serialize_message(index, message)).encode("utf-8")
+        # pending borne la sortie encore retenue par le compresseur depuis le dernier flush
+        if compressor and raw.tell() + pending + len(data) + 1024 > part_size:
+            close_part()
+            compressor = None
+        if compressor is None:
+            raw = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            compressor = gzip.GzipFile(filename=f"{name}.{fmt}", mode="wb", fileobj=raw)
+            parts.append(raw)
+            pending = 0
+        compressor.write(data)
+        pending += len(data)
+        if pending >= FLUSH_INTERVAL:
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+    if compressor:
+        close_part()
+
+    if len(parts) == 1:
+        return [(f"{name}.{fmt}.gz", parts[0])]
+    return [(f"{name}.part{i + 1}.{fmt}.gz", part) for i, part in enumerate(parts)]
+
+def group_parts(files, max_size, max_files):
+    """Group (filename, file object) parts into batches of at most `max_files` whose total
+    size, with `PART_OVERHEAD` per file, stays under `max_size`; a part is never split"""
+    batch, batch_size = [], 0
+    for filename, fp in files:
+        fp.seek(0, 2)
+        size = fp.tell()
+        fp.seek(0)
+        if batch and (batch_size + size + PART_OVERHEAD > max_size or len(batch) >= max_files):
+            yield batch
+            batch, batch_size = [], 0
+        batch.append((filename, fp))
+        batch_size += size + PART_OVERHEAD
+    if batch:
+        yield batch
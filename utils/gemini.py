@@ -1,8 +1,10 @@
 import google.generativeai as genai
+from google.generativeai import caching
 from utils.config import get_gemini_api_key, get_default_model
 import logging
 from google.api_core import exceptions as core_exceptions
 import time
+import datetime
 
 logger = logging.getLogger(__name__)
 
@@ -15,10 +17,12 @@ def generate_response(messages, model_name=None, system_prompt=None, max_retries
     for attempt in range(max_retries):
         try:
             logger.info(f"Messages envoyés à l'API : {messages}")
+            # Seuls role et parts sont transmis, les autres clés sont des métadonnées locales
+            history = [{"role": msg["role"], "parts": msg["parts"]} for msg in messages if msg["role"] in ("user", "model")]
             if system_prompt:
-                final_messages = [{"role": "user", "parts": [system_prompt]}] + [msg for msg in messages if msg["role"] in ("user", "model")]
+                final_messages = [{"role": "user", "parts": [system_prompt]}] + history
             else:
-                final_messages = [msg for msg in messages if msg["role"] in ("user", "model")]
+                final_messages = history
 
             if all(isinstance(part, str) for msg in final_messages for part in msg["parts"]):
                 # Cas texte seul : On envoie une liste simple de strings
@@ -41,6 +45,69 @@ def generate_response(messages, model_name=None, system_prompt=None, max_retries
             logger.error(f"Erreur lors de l'appel à l'API Gemini: {e}")
             raise
 
+def summarize_messages(messages, previous_summary=None, model_name=None):
+    """Summarize a span of conversation turns, folding in the previous summary if any"""
+    setup_gemini_api()
+    model = genai.GenerativeModel(model_name or get_default_model())
+    parts = [
+        "Tu maintiens la mémoire à long terme d'une conversation. "
+        "Mets à jour le résumé existant avec les nouveaux échanges ci-dessous, sans le réécrire de zéro : "
+        "conserve les faits, noms, préférences, décisions et questions en suspens, supprime les détails devenus inutiles. "
+        "Réponds uniquement avec le résumé mis à jour, de manière concise."
+    ]
+    parts.append(f"Résumé existant :\n{previous_summary}" if previous_summary else "Résumé existant : (aucun)")
+    parts.append("Nouveaux échanges :")
+    for msg in messages:
+        parts.append(f"[{msg['role']}]")
+        parts.extend(msg["parts"])
+    return model.generate_content(parts).text.strip()
+
+def describe_media(part, model_name=None):
+    """Turn a media part into a text stand-in: a transcript for audio, a description otherwise"""
+    setup_gemini_api()
+    model = genai.GenerativeModel(model_name or get_default_model())
+    if part["mime_type"].startswith("audio/"):
+        instruction = "Transcris fidèlement cet extrait audio. Réponds uniquement avec la transcription."
+    elif part["mime_type"].startswith("image/"):
+        instruction = "Décris précisément cette image, y compris tout texte visible. Réponds uniquement avec la description."
+    else:
+        instruction = "Résume précisément le contenu de ce fichier, y compris les informations importantes. Réponds uniquement avec le résumé."
+    return model.generate_content([instruction, part]).text.strip()
+
+def embed_texts(texts, task_type="retrieval_document", model_name="models/text-embedding-004"):
+    setup_gemini_api()
+    return genai.embed_content(model=model_name, content=texts, task_type=task_type)["embedding"]
+
+def _as_contents(messages):
+    return [{"role": msg["role"], "parts": msg["parts"]} for msg in messages]
+
+def create_cached_content(model_name, system_prompt, messages, ttl):
+    """Cache a system prompt and conversation prefix server-side; returns (cache name, expiry timestamp)"""
+    setup_gemini_api()
+    cache = caching.CachedContent.create(
+        model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+        system_instruction=system_prompt,
+        contents=_as_contents(messages),
+        ttl=datetime.timedelta(seconds=ttl)
+    )
+    return cache.name, cache.expire_time.timestamp()
+
+def extend_cached_content(cache_name, ttl):
+    setup_gemini_api()
+    cache = caching.CachedContent.get(cache_name)
+    cache.update(ttl=datetime.timedelta(seconds=ttl))
+    return cache.expire_time.timestamp()
+
+def delete_cached_content(cache_name):
+    setup_gemini_api()
+    caching.CachedContent.get(cache_name).delete()
+
+def generate_response_from_cache(cache_name, messages):
+    """Stream a response to `messages` appended to a cached prefix"""
+    setup_gemini_api()
+    model = genai.GenerativeModel.from_cached_content(cached_content=caching.CachedContent.get(cache_name))
+    return model.generate_content(_as_contents(messages), stream=True)
+
 def count_tokens(text, model_name=None):
     setup_gemini_api()
     model = genai.GenerativeModel(model_name or get_default_model())
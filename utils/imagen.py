@@ -0,0 +1,151 @@
+import io
+import asyncio
+import logging
+from collections import OrderedDict
+from utils.gemini import generate_images
+
+logger = logging.getLogger(__name__)
+
+class ImagenJob:
+    """A queued image generation request"""
+
+    def __init__(self, job_id, guild_id, author_id, prompt, aspect_ratio, negative_prompt, on_position=None):
+        self.id = job_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.prompt = prompt
+        self.aspect_ratio = aspect_ratio
+        self.negative_prompt = negative_prompt
+        self.on_position = on_position
+        self.last_position = None
+        # "guild" puis "global" tant que le job attend un slot, None une fois lancé
+        self.waiting_for = "guild"
+        self.task = None
+
+    @property
+    def key(self):
+        return (self.prompt, self.aspect_ratio, self.negative_prompt)
+
+class ImagenQueue:
+    """Runs Imagen generations off the event loop with bounded concurrency and an LRU result cache.
+
+    Jobs wait for a per-guild slot, then for a global slot. A generation that has started
+    keeps its slots until its worker thread returns, even if the job is cancelled, so
+    cancelled jobs never let more generations run than the configured limits.
+    """
+
+    def __init__(self, max_concurrent=2, max_per_guild=1, cache_size=16):
+        self.max_concurrent = max_concurrent
+        self.max_per_guild = max_per_guild
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._pending = []
+        self._jobs = {}
+        self._next_id = 1
+        # Références aux notifications de position en cours, pour qu'elles ne soient pas collectées
+        self._notifications = set()
+        # Créés à la demande pour être liés à la boucle du bot
+        self._slots = None
+        self._guild_slots = {}
+
+    def get_cached(self, prompt, aspect_ratio="1:1", negative_prompt=None):
+        """Get the PNG images of an identical previous request, or None"""
+        key = (prompt, aspect_ratio, negative_prompt)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        return None
+
+    def submit(self, guild_id, author_id, prompt, aspect_ratio="1:1", negative_prompt=None, on_position=None):
+        """Queue a generation and return its job; `job.task` resolves to a list of PNG bytes.
+
+        `on_position` is an optional coroutine function called with the job's position in the
+        queue each time it changes (0 once the generation has started).
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+        job = ImagenJob(self._next_id, guild_id, author_id, prompt, aspect_ratio, negative_prompt, on_position)
+        self._next_id += 1
+        self._jobs[job.id] = job
+        self._pending.append(job)
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def position(self, job):
+        """1-based position of a job among the jobs waiting for the same slot, 0 if it has started.
+
+        A job waiting for its guild slot is behind the older pending jobs of its guild; a job
+        holding its guild slot is behind the older jobs waiting for a global slot.
+        """
+        if job not in self._pending:
+            return 0
+        ahead = self._pending[:self._pending.index(job)]
+        if job.waiting_for == "global":
+            return sum(1 for other in ahead if other.waiting_for == "global") + 1
+        return sum(1 for other in ahead if other.guild_id == job.guild_id) + 1
+
+    def get_author_jobs(self, author_id):
+        """Get the unfinished jobs submitted by a user, oldest first"""
+        return [job for job in self._jobs.values() if job.author_id == author_id]
+
+    def cancel(self, job_id, author_id):
+        """Cancel a job submitted by `author_id`; returns False if there is no such job"""
+        job = self._jobs.get(job_id)
+        if job is None or job.author_id != author_id:
+            return False
+        job.task.cancel()
+        return True
+
+    def _notify_positions(self):
+        for job in list(self._jobs.values()):
+            position = self.position(job)
+            if job.on_position and position != job.last_position:
+                job.last_position = position
+                task = asyncio.create_task(job.on_position(position))
+                self._notifications.add(task)
+                task.add_done_callback(self._notifications.discard)
+
+    async def _run(self, job):
+        guild_slots = self._guild_slots.setdefault(job.guild_id, asyncio.Semaphore(self.max_per_guild))
+        try:
+            await guild_slots.acquire()
+            job.waiting_for = "global"
+            self._notify_positions()
+            try:
+                await self._slots.acquire()
+            except BaseException:
+                guild_slots.release()
+                raise
+
+            job.waiting_for = None
+            self._pending.remove(job)
+            self._notify_positions()
+
+            future = asyncio.get_running_loop().run_in_executor(
+                None, self._generate, job.prompt, job.aspect_ratio, job.negative_prompt
+            )
+            future.add_done_callback(lambda _: (self._slots.release(), guild_slots.release()))
+            images = await asyncio.shield(future)
+
+            self._cache[job.key] = images
+            self._cache.move_to_end(job.key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return images
+        finally:
+            self._jobs.pop(job.id, None)
+            if job in self._pending:
+                self._pending.remove(job)
+                self._notify_positions()
+
+    @staticmethod
+    def _generate(prompt, aspect_ratio, negative_prompt):
+        """Generate and encode the images (runs in a worker thread)"""
+        logger.info(f"Génération Imagen: '{prompt}' ({aspect_ratio})")
+        result = generate_images(prompt, aspect_ratio=aspect_ratio, negative_prompt=negative_prompt)
+        images = []
+        for image in result.images:
+            with io.BytesIO() as image_binary:
+                image.save(image_binary, 'PNG')
+                images.append(image_binary.getvalue())
+        return images
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class LoopLagMonitor:
+    """Measures event loop scheduling lag and records the call sites that block it.
+
+    A heartbeat coroutine ticks on the loop every `interval` seconds. A sampler thread
+    watches the heartbeat: when the loop has not ticked for longer than `threshold`,
+    it captures the stack of the loop thread, which is the frame currently blocking it.
+    When the loop wakes up again, the measured lag is attributed to that call site.
+    """
+
+    def __init__(self, interval=0.05, threshold=0.25, dump_file=None, max_stack_depth=15):
+        self.interval = interval
+        self.threshold = threshold
+        self.dump_file = dump_file
+        self.max_stack_depth = max_stack_depth
+
+        # Structure: {call_site: {"count": int, "total_blocked": float, "max_blocked": float, "stack": [...]}}
+        self.offenders = {}
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.started_at = None
+
+        self._lock = threading.Lock()
+        self._last_tick = None
+        self._stall_site = None
+        self._stall_stack = None
+        self._loop_thread_id = None
+        self._task = None
+        self._sampler = None
+        self._stop_event = threading.Event()
+
+    def start(self, loop=None):
+        """Start the heartbeat and the sampler thread (idempotent)"""
+        if self._task and not self._task.done():
+            return
+        loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self.started_at = time.time()
+        self._stop_event.clear()
+        self._task = loop.create_task(self._heartbeat())
+        self._sampler = threading.Thread(target=self._sample, name="loop-lag-sampler", daemon=True)
+        self._sampler.start()
+        logger.info(f"Surveillance de la boucle asyncio démarrée (seuil: {self.threshold * 1000:.0f} ms)")
+
+    def stop(self):
+        """Stop monitoring"""
+        self._stop_event.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - expected
+            with self._lock:
+                self._last_tick = now
+                site, stack = self._stall_site, self._stall_stack
+                self._stall_site = None
+                self._stall_stack = None
+            if lag > self.threshold:
+                self._record(site or "<inconnu>", stack or [], lag)
+
+    def _sample(self):
+        while not self._stop_event.wait(min(self.interval, self.threshold / 4)):
+            with self._lock:
+                stalled = time.monotonic() - self._last_tick > self.threshold
+                already_captured = self._stall_site is not None
+            if not stalled or already_captured:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=self.max_stack_depth)
+            site = self._call_site(stack)
+            with self._lock:
+                # Le heartbeat a pu repartir pendant la capture
+                if time.monotonic() - self._last_tick > self.threshold:
+                    self._stall_site = site
+                    self._stall_stack = traceback.format_list(stack)
+
+    def _call_site(self, stack):
+        """Return the innermost frame belonging to the project, falling back to the innermost frame"""
+        for frame in reversed(stack):
+            filename = os.path.abspath(frame.filename)
+            if filename.startswith(PROJECT_ROOT) and os.path.join(PROJECT_ROOT, ".venv") not in filename:
+                return f"{os.path.relpath(filename, PROJECT_ROOT)}:{frame.lineno} ({frame.name})"
+        if stack:
+            frame = stack[-1]
+            return f"{frame.filename}:{frame.lineno} ({frame.name})"
+        return "<inconnu>"
+
+    def _record(self, site, stack, lag):
+        with self._lock:
+            entry = self.offenders.setdefault(site, {"count": 0, "total_blocked": 0.0, "max_blocked": 0.0, "stack": stack})
+            entry["count"] += 1
+            entry["total_blocked"] += lag
+            entry["max_blocked"] = max(entry["max_blocked"], lag)
+            if stack:
+                entry["stack"] = stack
+            self.stall_count += 1
+            self.max_lag = max(self.max_lag, lag)
+        logger.warning(f"Boucle asyncio bloquée pendant {lag * 1000:.0f} ms par {site}")
+
+    def get_top_offenders(self, limit=10):
+        """Get call sites sorted by total blocked time"""
+        with self._lock:
+            items = [(site, dict(entry)) for site, entry in self.offenders.items()]
+        items.sort(key=lambda item: item[1]["total_blocked"], reverse=True)
+        return items[:limit]
+
+    def format_report(self, limit=10):
+        """Format a human readable summary of the worst offenders"""
+        offenders = self.get_top_offenders(limit)
+        if not offenders:
+            return f"Aucun blocage de la boucle au-delà de {self.threshold * 1000:.0f} ms détecté."
+        lines = [f"Blocages de la boucle asyncio (seuil {self.threshold * 1000:.0f} ms, {self.stall_count} blocages, max {self.max_lag * 1000:.0f} ms):"]
+        for site, entry in offenders:
+            lines.append(f"- `{site}`: {entry['count']}x, total {entry['total_blocked']:.2f} s, max {entry['max_blocked'] * 1000:.0f} ms")
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+        """Write the aggregated statistics and stacks to a JSON file and return its path"""
+        path = path or self.dump_file
+        with self._lock:
+            data = {
+                "started_at": self.started_at,
+                "dumped_at": time.time(),
+                "threshold": self.threshold,
+                "stall_count": self.stall_count,
+                "max_lag": self.max_lag,
+                "offenders": self.offenders,
+            }
+            content = json.dumps(data, ensure_ascii=False, indent=2)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    def reset(self):
+        """Forget all recorded offenders"""
+        with self._lock:
+            self.offenders = {}
+            self.stall_count = 0
+            self.max_lag = 0.0
@@ -0,0 +1,125 @@
+import json
+import time
+import logging
+import threading
+from utils.config import get_model_catalogue_file, get_model_catalogue_ttl
+from utils.gemini import list_models
+
+logger = logging.getLogger(__name__)
+
+FORCED_REFRESH_INTERVAL = 60  # Secondes minimum entre deux rafraîchissements pour un modèle inconnu
+
+def _fetch_catalogue():
+    """Fetch the model catalogue from the Gemini API as plain dicts"""
+    return [
+        {
+            "name": model.name,
+            "display_name": model.display_name,
+            "description": model.description,
+            "input_token_limit": model.input_token_limit,
+            "output_token_limit": model.output_token_limit,
+            "supported_generation_methods": list(model.supported_generation_methods),
+        }
+        for model in list_models()
+    ]
+
+class ModelRegistry:
+    """Disk-cached catalogue of the available models, refreshed in the background once stale"""
+
+    def __init__(self, cache_file, ttl, fetch=None):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.fetch = fetch or _fetch_catalogue
+
+        # Structure: {"fetched_at": float, "models": {short_name: {...}}}
+        self.fetched_at = 0
+        self.models = {}
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._forced_refresh_at = 0
+        self._load()
+
+    @staticmethod
+    def _short_name(name):
+        return name[len("models/"):] if name.startswith("models/") else name
+
+    def _load(self):
+        """Load the catalogue from the cache file if it exists"""
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.fetched_at = data["fetched_at"]
+            self.models = data["models"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    def refresh(self):
+        """Fetch the catalogue synchronously and save it to the cache file"""
+        models = {self._short_name(model["name"]): model for model in self.fetch()}
+        with self._lock:
+            self.models = models
+            self.fetched_at = time.time()
+            with open(self.cache_file, "w", encoding="utf-8") as f:
+                json.dump({"fetched_at": self.fetched_at, "models": self.models}, f, ensure_ascii=False, indent=2)
+        logger.info(f"Catalogue des modèles mis à jour ({len(models)} modèles)")
+
+    def _refresh_safely(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Erreur lors de la mise à jour du catalogue des modèles: {e}")
+
+    def refresh_in_background(self, force=False):
+        """Start a background refresh if the catalogue is stale (or `force`) and none is running"""
+        if not force and not self.is_stale():
+            return
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(target=self._refresh_safely, name="model-catalogue-refresh", daemon=True)
+        self._refresh_thread.start()
+
+    def refresh_if_unknown(self, model_name):
+        """Refresh the catalogue synchronously if `model_name` is not in it (a model released or
+        enabled since the last fetch), at most once every FORCED_REFRESH_INTERVAL seconds"""
+        if not self.models or self.get(model_name) is not None:
+            return
+        if time.time() - self._forced_refresh_at < FORCED_REFRESH_INTERVAL:
+            return
+        self._forced_refresh_at = time.time()
+        self._refresh_safely()
+
+    def list(self):
+        """Get all known models"""
+        self.refresh_in_background()
+        with self._lock:
+            return list(self.models.values())
+
+    def get(self, model_name):
+        """Get a model's catalogue entry, or None if unknown"""
+        self.refresh_in_background()
+        with self._lock:
+            return self.models.get(self._short_name(model_name))
+
+    def validate(self, model_name):
+        """Return an error message if the model cannot be used for generation, None otherwise.
+
+        An empty catalogue (never fetched) accepts every model, as before.
+        """
+        if not self.models:
+            return None
+        model = self.get(model_name)
+        if model is None:
+            return f"Modèle inconnu : {model_name}. Utilisez ?debug_listmodels pour voir les modèles disponibles."
+        if "generateContent" not in model["supported_generation_methods"]:
+            return f"Le modèle {model_name} ne supporte pas la génération de contenu."
+        return None
+
+    def get_input_token_limit(self, model_name):
+        """Get a model's input window in tokens, or None if unknown"""
+        model = self.get(model_name)
+        return model["input_token_limit"] if model else None
+
+model_registry = ModelRegistry(get_model_catalogue_file(), get_model_catalogue_ttl())
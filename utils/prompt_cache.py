@@ -0,0 +1,151 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from utils.gemini import (
+    create_cached_content, extend_cached_content, delete_cached_content, generate_response_from_cache, generate_response
+)
+
+logger = logging.getLogger(__name__)
+
+class GeminiCacheBackend:
+    """Server-side cached content through the Gemini API"""
+
+    def create(self, model_name, system_prompt, messages, ttl):
+        return create_cached_content(model_name, system_prompt, messages, ttl)
+
+    def extend(self, cache_name, ttl):
+        return extend_cached_content(cache_name, ttl)
+
+    def delete(self, cache_name):
+        delete_cached_content(cache_name)
+
+    def generate(self, cache_name, messages):
+        return generate_response_from_cache(cache_name, messages)
+
+def _fingerprint(message):
+    content = json.dumps({"role": message["role"], "parts": message["parts"]}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+class PromptCache:
+    """Keeps the system prompt and the stable part of a channel's history in a server-side cache.
+
+    Each turn only the messages after the cached prefix are sent. The prefix is checked
+    against content fingerprints, so trimming, compaction or media aging of cached
+    messages, or a new model or system prompt, invalidate it and a new cache is created.
+    Once `refresh_tokens` of history have accumulated after the prefix, the cache is
+    recreated to cover them; its TTL is extended when it gets close to expiry.
+    The last `keep_recent` messages are never cached since they are still changing.
+
+    `token_counter` maps a list of messages to their token counts. `backend` can be
+    replaced by a local stand-in exposing the same four methods, and `fallback`
+    (generate_response by default) serves turns whose history is too short to cache.
+    Turns whose cached generation fails before the first chunk (cache evicted server-side,
+    for instance) also fall back to the full context, and a model/system prompt pair whose
+    cache creation failed is not retried before `ttl` seconds.
+    """
+
+    def __init__(self, token_counter, backend=None, fallback=None, min_tokens=32768, ttl=3600, refresh_tokens=32768, keep_recent=2):
+        self.token_counter = token_counter
+        self.backend = backend or GeminiCacheBackend()
+        self.fallback = fallback or generate_response
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.refresh_tokens = refresh_tokens
+        self.keep_recent = keep_recent
+
+        self.name = None
+        self.model_name = None
+        self.system_prompt = None
+        self.fingerprints = []
+        self.expire_at = 0
+        # Structure: {(model_name, system_prompt): time.time() avant lequel ne pas recréer de cache}
+        self._create_blocked_until = {}
+        self._lock = threading.Lock()
+
+    def _matches(self, model_name, system_prompt, fingerprints):
+        return (self.name is not None and
+                self.model_name == model_name and
+                self.system_prompt == system_prompt and
+                time.time() < self.expire_at and
+                fingerprints[:len(self.fingerprints)] == self.fingerprints)
+
+    def invalidate(self):
+        """Forget the current cache and delete it server-side (best effort)"""
+        with self._lock:
+            self._drop()
+
+    def _drop(self):
+        if self.name:
+            try:
+                self.backend.delete(self.name)
+            except Exception as e:
+                logger.warning(f"Impossible de supprimer le cache de prompt {self.name}: {e}")
+        self.name = None
+        self.fingerprints = []
+        self.expire_at = 0
+
+    def prepare(self, messages, model_name, system_prompt):
+        """Return (cache name or None, messages to send) for this turn"""
+        history = [msg for msg in messages if msg["role"] in ("user", "model")]
+        fingerprints = [_fingerprint(msg) for msg in history]
+        stable = max(len(history) - self.keep_recent, 0)
+
+        with self._lock:
+            if self._matches(model_name, system_prompt, fingerprints):
+                uncached_tokens = sum(self.token_counter(history[len(self.fingerprints):stable]))
+                if uncached_tokens < self.refresh_tokens:
+                    if self.expire_at - time.time() < self.ttl / 4:
+                        self.expire_at = self.backend.extend(self.name, self.ttl)
+                    return self.name, history[len(self.fingerprints):]
+
+            prefix_tokens = sum(self.token_counter(history[:stable]))
+            if prefix_tokens < self.min_tokens:
+                if self.name:
+                    self._drop()
+                return None, messages
+
+            self._drop()
+            key = (model_name, system_prompt)
+            if time.time() < self._create_blocked_until.get(key, 0):
+                return None, messages
+            try:
+                self.name, self.expire_at = self.backend.create(model_name, system_prompt, history[:stable], self.ttl)
+            except Exception:
+                # Modèle sans cache de contexte, contenu refusé...: inutile de retenter à chaque tour
+                self._create_blocked_until[key] = time.time() + self.ttl
+                raise
+            self._create_blocked_until.pop(key, None)
+            self.model_name = model_name
+            self.system_prompt = system_prompt
+            self.fingerprints = fingerprints[:stable]
+            logger.info(f"Cache de prompt {self.name} créé: {stable} messages, ~{prefix_tokens} tokens")
+            return self.name, history[stable:]
+
+    def generate(self, messages, model_name, system_prompt=None):
+        """Same signature as generate_response: stream a response, sending only the uncached suffix"""
+        try:
+            cache_name, suffix = self.prepare(messages, model_name, system_prompt)
+        except Exception as e:
+            logger.warning(f"Cache de prompt indisponible, envoi du contexte complet: {e}")
+            with self._lock:
+                self._drop()
+            cache_name = None
+        if cache_name is None:
+            yield from self.fallback(messages, model_name, system_prompt)
+            return
+
+        started = False
+        try:
+            for chunk in self.backend.generate(cache_name, suffix):
+                started = True
+                yield chunk
+        except Exception as e:
+            if started:
+                raise
+            logger.warning(f"Génération depuis le cache de prompt {cache_name} impossible, envoi du contexte complet: {e}")
+            with self._lock:
+                if self.name == cache_name:
+                    self._drop()
+            yield from self.fallback(messages, model_name, system_prompt)
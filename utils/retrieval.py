@@ -0,0 +1,169 @@
+import re
+import json
+import math
+import zlib
+import heapq
+import logging
+import threading
+from utils.gemini import embed_texts
+
+logger = logging.getLogger(__name__)
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+def message_text(message):
+    """Concatenate the text parts of a message (media parts are ignored)"""
+    texts = []
+    for part in message["parts"]:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict) and "text" in part:
+            texts.append(part["text"])
+    return "\n".join(texts)
+
+class HashingEmbedder:
+    """Offline embedding stand-in: a signed, hashed bag of words and bigrams.
+
+    Deterministic across runs (crc32 rather than the salted built-in hash) and
+    sparse, so vectors are stored and compared as {dimension: weight} dicts.
+    """
+
+    def __init__(self, dimensions=4096):
+        self.dimensions = dimensions
+        self.name = f"hashing:{dimensions}"
+
+    def _embed(self, text):
+        words = [word for word in WORD_PATTERN.findall(text.lower()) if len(word) > 2]
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        counts = {}
+        for feature in features:
+            digest = zlib.crc32(feature.encode("utf-8"))
+            index = digest % self.dimensions
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            counts[index] = counts.get(index, 0.0) + sign
+        vector = {index: math.copysign(1 + math.log(abs(count)), count) for index, count in counts.items() if count}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {index: weight / norm for index, weight in vector.items()} if norm else {}
+
+    def __call__(self, texts, task_type="retrieval_document"):
+        return [self._embed(text) for text in texts]
+
+class GeminiEmbedder:
+    """Dense embeddings from the Gemini embedding API"""
+
+    def __init__(self, model_name="models/text-embedding-004"):
+        self.model_name = model_name
+        self.name = f"gemini:{model_name}"
+
+    def __call__(self, texts, task_type="retrieval_document"):
+        return embed_texts(texts, task_type, self.model_name)
+
+def similarity(a, b):
+    """Dot product of two normalized vectors, sparse (dict) or dense (list)"""
+    if isinstance(a, dict):
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(weight * b.get(index, 0.0) for index, weight in a.items())
+    return sum(x * y for x, y in zip(a, b))
+
+def message_key(message):
+    """Stable identity of a message across restarts, None for undated (legacy) messages"""
+    timestamp = message.get("timestamp")
+    return None if timestamp is None else f"{message['role']}:{timestamp!r}"
+
+class RetrievalIndex:
+    """Append-only, disk-backed index of past turns, searched by embedding similarity.
+
+    Messages are identified by `message_key`, so adding a message twice (catch-up
+    after a restart racing with new messages, for instance) only indexes it once.
+    The first line of the file records the embedder's name; vectors from another
+    embedder are not comparable, so a mismatching index is emptied and rebuilt.
+    """
+
+    def __init__(self, index_file, embedder):
+        self.index_file = index_file
+        self.embedder = embedder
+        # Structure: [{"role": str, "timestamp": float, "text": str, "vector": dict | list}, ...]
+        self.entries = []
+        self.keys = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        entries = []
+        embedder_name = None
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if "vector" not in entry:
+                        embedder_name = entry.get("embedder")
+                        continue
+                    if isinstance(entry["vector"], dict):
+                        entry["vector"] = {int(index): weight for index, weight in entry["vector"].items()}
+                    entries.append(entry)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            logger.error(f"Index de recherche {self.index_file} corrompu, lignes suivantes ignorées: {e}")
+
+        recorded = embedder_name
+        if embedder_name is None and entries:
+            # Index créé avant l'enregistrement de l'embedder: on le déduit du type des vecteurs
+            embedder_name = HashingEmbedder().name if isinstance(entries[0]["vector"], dict) else GeminiEmbedder().name
+        if entries and embedder_name != self.embedder.name:
+            logger.warning(f"Index de recherche {self.index_file} construit avec {embedder_name}, reconstruit avec {self.embedder.name}")
+            entries = []
+        self.entries = entries
+        self.keys = {message_key(entry) for entry in entries}
+        if recorded != self.embedder.name:
+            self._rewrite()
+
+    def _rewrite(self):
+        """Write the header and the current entries to the index file"""
+        with open(self.index_file, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"embedder": self.embedder.name}) + "\n")
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def is_indexed(self, message):
+        key = message_key(message)
+        return key is not None and key in self.keys
+
+    def add(self, messages):
+        """Embed and append messages that contain text and are not indexed yet"""
+        messages = [message for message in messages if message_text(message).strip() and not self.is_indexed(message)]
+        if not messages:
+            return
+        vectors = self.embedder([message_text(message) for message in messages])
+        with self._lock:
+            entries = []
+            for message, vector in zip(messages, vectors):
+                # Un autre thread a pu indexer le même message pendant le calcul des vecteurs
+                if self.is_indexed(message):
+                    continue
+                entries.append({"role": message["role"], "timestamp": message.get("timestamp"), "text": message_text(message), "vector": vector})
+                self.keys.add(message_key(message))
+            self.entries.extend(entries)
+            with open(self.index_file, "a", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def search(self, query, top_k, before=None):
+        """Get the `top_k` entries most similar to `query`, older than `before` if given, oldest first"""
+        if not query.strip() or not self.entries:
+            return []
+        query_vector = self.embedder([query], task_type="retrieval_query")[0]
+        with self._lock:
+            candidates = [entry for entry in self.entries
+                          if before is None or entry["timestamp"] is None or entry["timestamp"] < before]
+        scored = ((similarity(query_vector, entry["vector"]), position, entry) for position, entry in enumerate(candidates))
+        best = heapq.nlargest(top_k, (item for item in scored if item[0] > 0), key=lambda item: item[0])
+        # Les ajouts en tâche de fond ne sont pas forcément dans l'ordre chronologique
+        return [entry for _, _, entry in sorted(best, key=lambda item: (item[2]["timestamp"] or 0, item[1]))]
+
+    def clear(self):
+        with self._lock:
+            self.entries = []
+            self.keys = set()
+            self._rewrite()
@@ -0,0 +1,170 @@
+import time
+import asyncio
+import logging
+import threading
+from utils.gemini import generate_response
+
+logger = logging.getLogger(__name__)
+
+class _Attempt:
+    """One streaming generation running in a worker thread, feeding an asyncio queue"""
+
+    def __init__(self, backend, loop, messages, model_name, system_prompt):
+        self.model_name = model_name
+        self.queue = asyncio.Queue()
+        self.started_at = time.monotonic()
+        self.failed = False
+        self._loop = loop
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(
+            target=self._pump, args=(backend, messages, model_name, system_prompt),
+            name=f"generation-{model_name}", daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, kind, value):
+        self._loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+
+    def _pump(self, backend, messages, model_name, system_prompt):
+        try:
+            for chunk in backend(messages, model_name, system_prompt):
+                if self._cancelled.is_set():
+                    return
+                self._put("chunk", chunk.text)
+            self._put("end", None)
+        except Exception as e:
+            self._put("error", e)
+
+    def cancel(self):
+        """Stop forwarding chunks; the thread exits at the next chunk it receives"""
+        self._cancelled.set()
+
+class RoutedResponse:
+    """Async iterator over the text chunks of the fastest model; `model` holds the winner once known"""
+
+    def __init__(self, router, messages, model_name, system_prompt, prompt_cache=None):
+        self.router = router
+        self.messages = messages
+        self.model_name = model_name
+        self.system_prompt = system_prompt
+        self.prompt_cache = prompt_cache
+        self.model = None
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        loop = asyncio.get_running_loop()
+        router = self.router
+        fallback = router.fallback_model if router.fallback_model != self.model_name else None
+        # Le cache de prompt est propre au modèle principal, le modèle de secours reçoit tout le contexte
+        primary_backend = self.prompt_cache.generate if self.prompt_cache else router.backend
+        attempts = [_Attempt(primary_backend, loop, self.messages, self.model_name, self.system_prompt)]
+        getters = {asyncio.ensure_future(attempts[0].queue.get()): attempts[0]}
+        hedge_at = loop.time() + router.hedge_deadline if fallback else None
+
+        def start_hedge():
+            logger.info(f"Requête couverte: {fallback} lancé en parallèle de {self.model_name}")
+            hedge = _Attempt(router.backend, loop, self.messages, fallback, self.system_prompt)
+            attempts.append(hedge)
+            getters[asyncio.ensure_future(hedge.queue.get())] = hedge
+
+        winner = None
+        try:
+            # Course au premier chunk
+            while winner is None:
+                timeout = None if hedge_at is None else max(0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(getters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    start_hedge()
+                    continue
+                for getter in done:
+                    attempt = getters.pop(getter)
+                    kind, value = getter.result()
+                    if kind == "error":
+                        attempt.failed = True
+                        logger.warning(f"Échec de la génération avec {attempt.model_name}: {value}")
+                        if hedge_at is not None:
+                            # Pas la peine d'attendre l'échéance, on bascule tout de suite
+                            hedge_at = None
+                            start_hedge()
+                        elif not getters:
+                            raise value
+                        continue
+                    winner, first = attempt, (kind, value)
+                    break
+
+            router.record_first_chunk(winner.model_name, time.monotonic() - winner.started_at)
+            for attempt in attempts:
+                if attempt is not winner and not attempt.failed:
+                    # Son temps de premier chunk n'est pas connu (seulement une borne inférieure)
+                    router.record_hedged_out(attempt.model_name)
+                    attempt.cancel()
+            for getter in getters:
+                getter.cancel()
+            self.model = winner.model_name
+
+            kind, value = first
+            while kind == "chunk":
+                yield value
+                kind, value = await winner.queue.get()
+            if kind == "error":
+                raise value
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            for getter in getters:
+                getter.cancel()
+
+class ModelRouter:
+    """Tracks per-model time to first chunk and hedges slow generations with a fallback model.
+
+    If the primary model has not produced its first chunk after `hedge_deadline` seconds
+    (or fails before that), the same request is sent to `fallback_model`; whichever model
+    answers first is streamed and the other one is dropped. `backend` has the signature of
+    `generate_response` and can be replaced by a local fake to simulate slow models.
+    """
+
+    def __init__(self, fallback_model=None, hedge_deadline=5.0, backend=None, smoothing=0.2):
+        self.fallback_model = fallback_model
+        self.hedge_deadline = hedge_deadline
+        self.backend = backend or generate_response
+        self.smoothing = smoothing
+        # Structure: {model_name: {"ttfc": float | None (moyenne glissante), "count": int, "hedged_out": int}}
+        # hedged_out compte les générations abandonnées avant leur premier chunk, hors moyenne
+        self.stats = {}
+
+    def stream(self, messages, model_name, system_prompt=None, prompt_cache=None):
+        """Start a routed generation; iterate the result with `async for`.
+
+        With a `prompt_cache`, the primary model only receives the uncached suffix.
+        """
+        return RoutedResponse(self, messages, model_name, system_prompt, prompt_cache)
+
+    def _entry(self, model_name):
+        return self.stats.setdefault(model_name, {"ttfc": None, "count": 0, "hedged_out": 0})
+
+    def record_first_chunk(self, model_name, seconds):
+        entry = self._entry(model_name)
+        if entry["ttfc"] is None:
+            entry["ttfc"] = seconds
+        else:
+            entry["ttfc"] += self.smoothing * (seconds - entry["ttfc"])
+        entry["count"] += 1
+
+    def record_hedged_out(self, model_name):
+        self._entry(model_name)["hedged_out"] += 1
+
+    def format_stats(self):
+        if not self.stats:
+            return "Aucune génération mesurée."
+        lines = ["Temps moyen avant le premier chunk:"]
+        for model_name, entry in sorted(self.stats.items(), key=lambda item: (item[1]["ttfc"] is None, item[1]["ttfc"] or 0)):
+            line = f"- {model_name}: {entry['ttfc']:.2f} s ({entry['count']} mesures)" if entry["ttfc"] is not None else f"- {model_name}: aucune mesure"
+            if entry["hedged_out"]:
+                line += f", {entry['hedged_out']} fois devancé par l'autre modèle"
+            lines.append(line)
+        if self.fallback_model:
+            lines.append(f"Modèle de secours: {self.fallback_model} après {self.hedge_deadline:.1f} s")
+        return "\n".join(lines)